@@ -1,5 +1,8 @@
+from typing import Sequence
+
 import chess
 import numpy as np
+import torch
 
 import logging
 
@@ -31,19 +34,11 @@ def _from_square_to_uci(square: int) -> str:
     return square_uci
 
 
-def decode_move(action: list[int] | np.ndarray, output_in_uci: bool = True) -> chess.Move | str:
+def _index_to_uci(index_move: int) -> str:
     # 64 * 64 + {[(8-2)*3 + 2*2]*6}*2
     # BOARD_SIZE * BOARD_SIZE + [(BOARD_ROWS-EDGE_COLUMNS)*3 + EDGE_COLUMNS * len(PIECE_PROMOTION_SYMBOLS)] * 2
     # The second term refers to the promotion moves
     # The last `*2` refers to both white and black
-
-    try:
-        # index_move = action.one_hot_list.index(1)
-        index_move = action.index(1)  # action is a one hot encoded vector
-    except Exception as err:
-        logging.error('The one hot encoded list in the action object has no element equal to 1!')
-        raise err
-
     if index_move < BOARD_MOVES:  # NOT a promotion move
         # 0 => 'a1' ... 63 => 'h8'
         from_square = index_move // BOARD_SIZE
@@ -51,9 +46,7 @@ def decode_move(action: list[int] | np.ndarray, output_in_uci: bool = True) -> c
         to_square = index_move % BOARD_SIZE
         # a1a1, c6c6, f9f9, etc..
         if from_square == to_square:
-            if output_in_uci:
-                return '0000'
-            return chess.Move.null()
+            return '0000'
 
         from_square_uci = _from_square_to_uci(from_square)
         to_square_uci = _from_square_to_uci(to_square)
@@ -91,61 +84,135 @@ def decode_move(action: list[int] | np.ndarray, output_in_uci: bool = True) -> c
         to_square_uci = f'{to_column_square}{to_row_square}'
         assert from_square_uci != to_square_uci
         move_string = f'{from_square_uci}{to_square_uci}{promotion_piece}'
+    return move_string
+
+
+def _build_tables() -> tuple[list[chess.Move], np.ndarray, np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+    # Decode every index of the action space once, so that encoding and decoding are just table lookups
+    index_to_move = [chess.Move.from_uci(_index_to_uci(i)) for i in range(ACTION_SPACE_SIZE)]
+    index_to_uci = np.array([move.uci() for move in index_to_move])
+    index_to_from_square = np.array([move.from_square for move in index_to_move], dtype=np.uint8)
+    index_to_to_square = np.array([move.to_square for move in index_to_move], dtype=np.uint8)
+    index_to_promotion = np.array([move.promotion or 0 for move in index_to_move], dtype=np.uint8)
+
+    # (from square, to square, promotion piece type) => index, -1 if the move is outside the action space
+    move_to_index = np.full((BOARD_SIZE, BOARD_SIZE, len(PIECE_SYMBOLS)), -1, dtype=np.int16)
+    # the from == to indices are all decoded to the null move, which is encoded as index 0
+    squares = np.arange(BOARD_SIZE)
+    move_to_index[:, :, 0] = squares[:, np.newaxis] * BOARD_SIZE + squares
+    for index_move in range(BOARD_MOVES, ACTION_SPACE_SIZE):
+        move = index_to_move[index_move]
+        move_to_index[move.from_square, move.to_square, move.promotion] = index_move
+    # promotions outside of PIECE_PROMOTION_SYMBOLS are treated as queen promotions
+    for piece_type in range(chess.KNIGHT, chess.KING):
+        if piece_type not in TO_REDUCED_PROMOTION_MAP:
+            move_to_index[:, :, piece_type] = move_to_index[:, :, chess.QUEEN]
+    return index_to_move, index_to_uci, index_to_from_square, index_to_to_square, index_to_promotion, move_to_index
+
+
+(_INDEX_TO_MOVE, INDEX_TO_UCI, INDEX_TO_FROM_SQUARE, INDEX_TO_TO_SQUARE, INDEX_TO_PROMOTION,
+ MOVE_TO_INDEX) = _build_tables()
+# index of the move mirrored vertically (as by `chess.Board.mirror`) of each index, promotions change side.
+# Below BOARD_MOVES the index is from * 64 + to, so mirroring both squares flips the same bits of the index
+MIRROR_INDEX = np.append(np.arange(BOARD_MOVES) ^ (56 * BOARD_SIZE + 56),
+                         MOVE_TO_INDEX[INDEX_TO_FROM_SQUARE[BOARD_MOVES:] ^ 56, INDEX_TO_TO_SQUARE[BOARD_MOVES:] ^ 56,
+                                       INDEX_TO_PROMOTION[BOARD_MOVES:]])
+
+
+def move_to_index(move: chess.Move | str) -> int:
+    """
+    Index of @move in the action space.
+    Promotions to a piece outside of PIECE_PROMOTION_SYMBOLS are treated as queen promotions.
+    """
+    if isinstance(move, str):
+        move = chess.Move.from_uci(move)
+    promotion = move.promotion or 0
+    if promotion and promotion not in TO_REDUCED_PROMOTION_MAP:
+        logging.debug(f"The move {move.uci()} promote to a piece outside of {PIECE_PROMOTION_SYMBOLS}. It will be treated as a queen promotion!")
+    index_move = int(MOVE_TO_INDEX[move.from_square, move.to_square, promotion])
+    if index_move < 0:
+        raise AssertionError(f'Promotion {move.uci()} is not in the action space!!')
+    return index_move
+
+
+def index_to_move(index_move: int, output_in_uci: bool = True) -> chess.Move | str:
+    """
+    Move (or UCI string) of the index @index_move of the action space.
+    """
+    if output_in_uci:
+        return str(INDEX_TO_UCI[index_move])
+    return _INDEX_TO_MOVE[index_move]
 
+
+def decode_move(action: list[int] | np.ndarray, output_in_uci: bool = True) -> chess.Move | str:
     try:
-        move = chess.Move.from_uci(move_string)
-    except chess.InvalidMoveError as err:
-        logging.error(f"Move {move_string} is not a valid UCI string")
+        if isinstance(action, np.ndarray):
+            index_move = int(np.flatnonzero(action == 1)[0])
+        else:
+            index_move = action.index(1)  # action is a one hot encoded vector
+    except Exception as err:
+        logging.error('The one hot encoded list in the action object has no element equal to 1!')
         raise err
-    if output_in_uci:
-        return move.uci()
-    return move
+    return index_to_move(index_move, output_in_uci)
 
 
 def encode_move(move: chess.Move | str, output_in_numpy: bool = True) -> list[int] | np.ndarray:
-    if isinstance(move, str):
-        move = chess.Move.from_uci(move)
-    action = [0] * ACTION_SPACE_SIZE
-    # The logic is more understandable looking at `decode_move`
-    # here I just reverse the operations
-    if not move.promotion:
-        index_move = move.from_square * BOARD_SIZE
-        index_move = index_move + move.to_square
-    else:
-        index_move = 0  # Initialized
-        to_square_row = move.to_square // BOARD_ROWS  # Row
-        if to_square_row == BOARD_ROWS - 1:
-            side = 0  # White
-        elif to_square_row == 0:
-            side = 1  # Black
-        else:
-            raise AssertionError('Promotion from row {from_square_row} to row {to_square_row}!!')
-        index_move += side * PROMOTION_MOVES_PER_SIDE
-        from_square_column = move.from_square % BOARD_ROWS  # Column
-        to_square_column = move.to_square % BOARD_ROWS  # Column
-        if from_square_column == 0:  # Left edge cell
-            assert to_square_column < 2, f'Promotion from column {from_square_column} to column {to_square_column}!!'
-            index_move += to_square_column
-        elif from_square_column == BOARD_ROWS - 1:  # Right edge cell
-            assert to_square_column > BOARD_ROWS - 3, f'Promotion from column {from_square_column} to column {to_square_column}!!'
-            index_move += PROMOTION_MOVES_PER_SIDE - 2 + (to_square_column % 2)
-        else:
-            index_move += 2 + ((from_square_column - 1) * 3) + (
-                        to_square_column - from_square_column + 1)  # (from_square_column - to_square_column + 1)
-        try:
-            index_move += TO_REDUCED_PROMOTION_MAP[move.promotion] * (PROMOTION_MOVES_PER_SIDE * 2)  # Offset of the promotion piece
-        except KeyError:
-            logging.debug(f"The move {move.uci()} promote to a piece outside of {PIECE_PROMOTION_SYMBOLS}. It will be treated as a queen promotion!")
-            index_move += TO_REDUCED_PROMOTION_MAP[5] * (PROMOTION_MOVES_PER_SIDE * 2)  # Offset of the promotion piece
-        index_move += BOARD_MOVES  # Offset of all moves that are not promotions
-    action[index_move] = 1
-    assert sum(action) == 1
+    index_move = move_to_index(move)
     if output_in_numpy:
-        return np.array(action)
+        action = np.zeros(ACTION_SPACE_SIZE, dtype=int)
+        action[index_move] = 1
+        return action
     else:
+        action = [0] * ACTION_SPACE_SIZE
+        action[index_move] = 1
         return action
 
 
+def legal_moves_mask(boards: Sequence[chess.Board]) -> np.ndarray:
+    """
+    Boolean mask of shape (N, ACTION_SPACE_SIZE) of the legal moves of each board, e.g. for a masked softmax.
+    Underpromotions outside of PIECE_PROMOTION_SYMBOLS are mapped to the queen promotion, as in `move_to_index`.
+    """
+    rows, from_squares, to_squares, promotions = [], [], [], []
+    for i, board in enumerate(boards):
+        for move in board.generate_legal_moves():
+            rows.append(i)
+            from_squares.append(move.from_square)
+            to_squares.append(move.to_square)
+            promotions.append(move.promotion or 0)
+    mask = np.zeros((len(boards), ACTION_SPACE_SIZE), dtype=bool)
+    mask[rows, MOVE_TO_INDEX[from_squares, to_squares, promotions]] = True
+    return mask
+
+
+def decode_topk(scores: torch.Tensor | np.ndarray, k: int = 1, legal_mask: torch.Tensor | np.ndarray = None,
+                output_in_uci: bool = True) -> tuple[list[list[chess.Move | str]], np.ndarray]:
+    """
+    Decode the k best moves of each row of a batch of policy outputs.
+
+    :param scores: (N, ACTION_SPACE_SIZE) logits or probabilities, e.g. the output of the model
+    :param k: number of moves to return for each row
+    :param legal_mask: None or the (N, ACTION_SPACE_SIZE) boolean mask of the legal moves (see `legal_moves_mask`).
+    Illegal moves get a score of -inf, so they are returned only when a row has less than k legal moves
+    :param output_in_uci: if True, return the moves as UCI strings instead of chess.Move objects
+    :return: the k best moves of each row, sorted by decreasing score, and their (N, k) scores
+    """
+    scores = torch.as_tensor(scores)
+    if legal_mask is not None:
+        legal_mask = torch.as_tensor(legal_mask, device=scores.device)
+        scores = scores.masked_fill(~legal_mask, -torch.inf)
+    values, indices = torch.topk(scores, k, dim=-1)
+    if values.dtype == torch.bfloat16:
+        # not supported by numpy
+        values = values.float()
+    values, indices = values.cpu().numpy(), indices.cpu().numpy()
+    if output_in_uci:
+        moves = INDEX_TO_UCI[indices].tolist()
+    else:
+        moves = [[_INDEX_TO_MOVE[index_move] for index_move in row] for row in indices.tolist()]
+    return moves, values
+
+
 def main():
     logging.basicConfig(level=logging.INFO)
     action = [0 for _ in range(ACTION_SPACE_SIZE)]
@@ -1,3 +1,8 @@
+import functools
+import itertools
+import operator
+from typing import Iterable, Sequence
+
 import chess
 import numpy as np
 
@@ -51,6 +56,211 @@ MAX_ARRAY_LEGAL_VALUE = OFFSET_ENPASSANT + 7
 MIN_INFO_LEGAL_VALUE = 0
 MAX_INFO_LEGAL_VALUE = np.inf
 
+# number of bitboards returned by `_bitboards`: 12 pieces, castling rooks, en passant pawn
+N_BITBOARDS = 14
+# bytes of a board in 'packed' mode: the little endian bitboards, followed by the additional info as uint16
+PACKED_SIZE = N_BITBOARDS * 8 + 3 * 2
+
+LOW_LEVEL_MODES = ['array', 'matrix', 'tensor', 'packed']
+# shape of a single encoded board, for each mode
+LOW_LEVEL_SHAPES = {(67,): 'array', (8, 8): 'matrix', (6, 8, 8): 'tensor', (PACKED_SIZE,): 'packed'}
+
+
+# bitboards of the 4 rook squares that can carry a castling right, in standard chess
+CASTLING_SQUARES_MASK = chess.BB_A1 | chess.BB_H1 | chess.BB_A8 | chess.BB_H8
+# DICTIONARY value of each of the 12 piece bitboards returned by `_bitboards`
+PIECE_VALUES = np.arange(1, 2 * OFFSET_COLOR + 1)
+# DICTIONARY value of the black piece of each tensor channel
+CHANNEL_VALUES = np.arange(1, OFFSET_COLOR + 1)
+
+
+def _build_mirror_tables() -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    # 'array'/'matrix' cell value after swapping the colour of its piece: the castling and en passant markers stay
+    # on the square of their piece, so they are kept
+    pieces = np.arange(2 * OFFSET_COLOR + 1)
+    swapped = np.where(pieces > OFFSET_COLOR, pieces - OFFSET_COLOR, np.where(pieces > 0, pieces + OFFSET_COLOR, 0))
+    cells = np.zeros(OFFSET_ENPASSANT + len(pieces), dtype=np.int64)
+    for marker in (0, OFFSET_CASTLING, OFFSET_ENPASSANT):
+        cells[marker:marker + len(pieces)] = swapped + marker
+    # 'array' position of each value of the mirrored board: squares mirrored vertically, additional info kept
+    array = np.append(np.arange(64) ^ 56, np.arange(64, 67))
+    # 'packed' byte of each byte of the mirrored board: the black and white bitboards are swapped, and reversing the
+    # bytes of a bitboard mirrors it vertically
+    bitboards = np.append(np.arange(OFFSET_COLOR, 2 * OFFSET_COLOR), np.arange(OFFSET_COLOR))
+    bitboards = np.append(bitboards, np.arange(2 * OFFSET_COLOR, N_BITBOARDS))
+    packed = np.append((bitboards[:, np.newaxis] * 8 + np.arange(7, -1, -1)).ravel(),
+                       np.arange(N_BITBOARDS * 8, PACKED_SIZE))
+    return cells, array, packed
+
+
+# tables of `mirror_batch`
+CELL_MIRROR, ARRAY_MIRROR, PACKED_MIRROR = _build_mirror_tables()
+
+
+def _bitboards(board: chess.Board) -> list[int]:
+    """
+    Collect the bitboards that describe the position of @board: the 12 piece bitboards (black pieces first, in the
+    same order of DICTIONARY), the rooks that still carry a castling right and the pawn that can be captured en passant.
+    """
+    masks = [board.pieces_mask(piece_type, color)
+             for color in (chess.BLACK, chess.WHITE) for piece_type in chess.PIECE_TYPES]
+    # same rights written by the fen, so that the encodings match the previous string based ones
+    masks.append(board.clean_castling_rights() & CASTLING_SQUARES_MASK)
+    if board.ep_square is not None:
+        # the pawn that moved sits one rank beyond the target ep square
+        s = 1 if board.ep_square < 32 else -1
+        masks.append(chess.BB_SQUARES[board.ep_square + s * 8])
+    else:
+        masks.append(chess.BB_EMPTY)
+    return masks
+
+
+def _unpack_bitboards(masks: np.ndarray) -> np.ndarray:
+    """
+    Unpack an array of uint64 bitboards of shape (..., k) into an array of bits of shape (..., k, 64), where the
+    element i of the last axis is the square i of the board.
+    """
+    bits = np.unpackbits(masks.astype('<u8').view(np.uint8), axis=-1, bitorder='little')
+    return bits.reshape(*masks.shape, 64)
+
+
+def _encode_planes(planes: np.ndarray, mode: str) -> np.ndarray:
+    """
+    Build the low level encoding of the bit planes of shape (..., N_BITBOARDS, 64) computed from `_bitboards`.
+    In 'array' mode the additional info is not appended.
+    """
+    lead = planes.shape[:-2]
+    pieces, castling, enpassant = planes[..., :12, :], planes[..., 12, :], planes[..., 13, :]
+    if mode == 'tensor':
+        arr = pieces[..., OFFSET_COLOR:, :].astype(int) - pieces[..., :OFFSET_COLOR, :]
+        # castling rooks and en passant pawns are marked by doubling their value
+        arr[..., CHANNEL_DICTIONARY['r'], :] *= 1 + castling
+        arr[..., CHANNEL_DICTIONARY['p'], :] *= 1 + enpassant
+        return arr.reshape(*lead, 6, 8, 8)
+
+    arr = PIECE_VALUES @ pieces
+    arr += OFFSET_CASTLING * castling + OFFSET_ENPASSANT * enpassant
+    if mode == 'matrix':
+        arr = arr.reshape(*lead, 8, 8)
+    return arr
+
+
+def _to_packed(masks: np.ndarray, additional: np.ndarray) -> np.ndarray:
+    """
+    Build the 'packed' encoding of shape (N, PACKED_SIZE) from the (N, N_BITBOARDS) bitboards and the (N, 3)
+    additional info. The bytes of the bitboards are the same that `np.packbits(..., bitorder='little')` would
+    produce from their bit planes.
+    """
+    packed = np.empty((len(masks), PACKED_SIZE), dtype=np.uint8)
+    packed[:, :N_BITBOARDS * 8] = masks.astype('<u8').view(np.uint8)
+    packed[:, N_BITBOARDS * 8:] = additional.astype('<u2').view(np.uint8)
+    return packed
+
+
+def _from_packed(packed: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Inverse of `_to_packed`: return the (N, N_BITBOARDS) bitboards and the (N, 3) additional info.
+    """
+    masks = np.ascontiguousarray(packed[:, :N_BITBOARDS * 8]).view('<u8')
+    additional = np.ascontiguousarray(packed[:, N_BITBOARDS * 8:]).view('<u2').astype(int)
+    return masks, additional
+
+
+def _validate_dtype(mode: str, dtype) -> np.dtype:
+    """
+    Check that @dtype can hold the encoding of @mode.
+    """
+    dtype = np.dtype(dtype)
+    if not np.issubdtype(dtype, np.integer):
+        raise TypeError("Error: argument dtype must be an integer type")
+    if mode == 'tensor' and not np.issubdtype(dtype, np.signedinteger):
+        raise ValueError("Error: argument dtype must be a signed integer type in 'tensor' mode")
+    return dtype
+
+
+def _encode_bitboards(masks: np.ndarray, additional: np.ndarray, mode: str,
+                      dtype: np.dtype) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Build the low level encoding of N boards, given their (N, N_BITBOARDS) bitboards and (N, 3) additional info.
+    In 'array' mode the counters saturate at the largest value of @dtype. The additional info is None in the modes
+    that embed it ('array' and 'packed').
+    """
+    if mode == 'packed':
+        return _to_packed(masks, additional), None
+
+    cells = _encode_planes(_unpack_bitboards(masks), mode).astype(dtype, copy=False)
+    if mode == 'array':
+        arr = np.empty((len(masks), 67), dtype=dtype)
+        arr[:, :64] = cells
+        arr[:, 64:] = np.minimum(additional, np.iinfo(dtype).max)
+        return arr, None
+    return cells, additional
+
+
+def _decode_planes(arr: np.ndarray, mode: str) -> np.ndarray:
+    """
+    Inverse of `_encode_planes`: build the bit planes of shape (N, N_BITBOARDS, 64) of a batch of N boards encoded
+    in @mode. In 'array' mode the additional info at the end of each array is ignored.
+    """
+    n = arr.shape[0]
+    planes = np.empty((n, N_BITBOARDS, 64), dtype=bool)
+    if mode == 'tensor':
+        arr = arr.reshape(n, 6, 64)
+        planes[:, 12] = np.abs(arr[:, CHANNEL_DICTIONARY['r']]) == 2
+        planes[:, 13] = np.abs(arr[:, CHANNEL_DICTIONARY['p']]) == 2
+        cells = (np.where(arr > 0, CHANNEL_VALUES[:, np.newaxis] + OFFSET_COLOR, 0) +
+                 np.where(arr < 0, CHANNEL_VALUES[:, np.newaxis], 0)).sum(axis=1)
+    else:
+        # explicit size, -1 cannot be inferred for an empty batch
+        cells = arr.reshape(n, int(np.prod(arr.shape[1:])))[:, :64]
+        planes[:, 12] = (OFFSET_CASTLING < cells) & (cells < OFFSET_ENPASSANT)
+        planes[:, 13] = cells > OFFSET_ENPASSANT
+        cells = cells - OFFSET_CASTLING * planes[:, 12] - OFFSET_ENPASSANT * planes[:, 13]
+    np.equal(cells[:, np.newaxis, :], PIECE_VALUES[:, np.newaxis], out=planes[:, :12])
+    return planes
+
+
+def _pack_bitboards(planes: np.ndarray) -> np.ndarray:
+    """
+    Inverse of `_unpack_bitboards`: pack bits of shape (..., k, 64) into uint64 bitboards of shape (..., k).
+    """
+    return np.packbits(planes, axis=-1, bitorder='little').view('<u8')[..., 0]
+
+
+def _decode_bitboards(arr: np.ndarray, mode: str) -> np.ndarray:
+    """
+    Inverse of `_encode_bitboards`: return the (N, N_BITBOARDS) bitboards of a batch of N boards encoded in @mode.
+    """
+    if mode == 'packed':
+        return _from_packed(arr)[0]
+    return _pack_bitboards(_decode_planes(arr, mode))
+
+
+def _set_bitboards(board: chess.Board, masks: list[int], additional_info: list[int]):
+    """
+    Inverse of `_bitboards`: overwrite the position of @board with the bitboards @masks and the additional info
+    (turn, half moves, full moves).
+    """
+    black, white = masks[:OFFSET_COLOR], masks[OFFSET_COLOR:2 * OFFSET_COLOR]
+    board.pawns, board.knights, board.bishops, board.rooks, board.queens, board.kings = (
+        b | w for b, w in zip(black, white))
+    board.promoted = chess.BB_EMPTY
+    board.occupied_co[chess.BLACK] = functools.reduce(operator.or_, black)
+    board.occupied_co[chess.WHITE] = functools.reduce(operator.or_, white)
+    board.occupied = board.occupied_co[chess.BLACK] | board.occupied_co[chess.WHITE]
+    board.castling_rights = masks[12] & CASTLING_SQUARES_MASK
+    if masks[13]:
+        # the target ep square is one rank behind the pawn that moved
+        i = chess.msb(masks[13])
+        s = 1 if i < 32 else -1
+        board.ep_square = i - s * 8
+    else:
+        board.ep_square = None
+
+    board.turn = bool(additional_info[0])
+    board.halfmove_clock = int(additional_info[1])
+    board.fullmove_number = int(additional_info[2])
+
 
 def validate_low_level_arg(low_level: tuple) -> tuple[np.ndarray, np.ndarray, str]:
     def validate_first():
@@ -58,10 +268,17 @@ def validate_low_level_arg(low_level: tuple) -> tuple[np.ndarray, np.ndarray, st
         info = None
         if type(arr) is not np.ndarray:
             raise TypeError("Error: the first element of argument `low_level` must be a numpy ndarray")
-        if arr.dtype != int:
+        if not np.issubdtype(arr.dtype, np.integer):
             raise TypeError("Error: the first element of argument `low_level` must have integer elements")
 
-        if arr.shape == (67,):
+        if arr.shape == (PACKED_SIZE,):
+            if arr.dtype != np.uint8:
+                raise TypeError("Error: the first element of argument `low_level` must have uint8 elements when "
+                                "packed")
+            info = _from_packed(arr[np.newaxis])[1][0]
+            m = 'packed'
+
+        elif arr.shape == (67,):
             info = arr[64:]
             arr = arr[:64]
             m = 'array'
@@ -80,8 +297,8 @@ def validate_low_level_arg(low_level: tuple) -> tuple[np.ndarray, np.ndarray, st
                 raise ValueError("Error: the tensor of argument `low_level` cannot have values different from"
                                  " -2, 1, 0, 1, 2")
         else:
-            raise RuntimeError("Error: the first element of argument `low_level` must have either shape (67,), (8,8) or"
-                               "(6, 8, 8)")
+            raise RuntimeError("Error: the first element of argument `low_level` must have either shape (67,), (8,8), "
+                               f"(6, 8, 8) or ({PACKED_SIZE},)")
         return arr, info, m
 
     def validate_info(info):
@@ -94,7 +311,7 @@ def validate_low_level_arg(low_level: tuple) -> tuple[np.ndarray, np.ndarray, st
         if add_info.shape != (3,):
             raise RuntimeError("Error: the second element of argument `low_level` must be either None or have "
                                "shape (3,)")
-        if add_info.dtype != int:
+        if not np.issubdtype(add_info.dtype, np.integer):
             raise TypeError("Error: the second element of argument `low_level` must be either None or have "
                             "integer elements")
         if np.any((add_info < MIN_INFO_LEGAL_VALUE) | (add_info > MAX_INFO_LEGAL_VALUE)):
@@ -117,143 +334,293 @@ def validate_low_level_arg(low_level: tuple) -> tuple[np.ndarray, np.ndarray, st
     return array, additional_info, mode
 
 
+def validate_low_level_batch(arrays: np.ndarray, info: np.ndarray = None) -> tuple[np.ndarray, np.ndarray, str]:
+    """
+    Batched counterpart of `validate_low_level_arg`: every check is run once on the whole batch.
+
+    :param arrays: the encoded boards, with shape (N, 67), (N, 8, 8), (N, 6, 8, 8) or (N, PACKED_SIZE)
+    :param info: None or the (N, 3) additional info of each board, ignored in 'array' and 'packed' mode. If None,
+    the next player of each board is assumed to be W and the counters are set to 0
+    :return: the boards, their additional info and the mode of the encoding
+    """
+    if type(arrays) is not np.ndarray:
+        raise TypeError("Error: argument `arrays` must be a numpy ndarray")
+    if not np.issubdtype(arrays.dtype, np.integer):
+        raise TypeError("Error: argument `arrays` must have integer elements")
+    if arrays.shape[1:] not in LOW_LEVEL_SHAPES:
+        raise RuntimeError("Error: argument `arrays` must have either shape (N, 67), (N, 8, 8), (N, 6, 8, 8) or "
+                           f"(N, {PACKED_SIZE})")
+    mode = LOW_LEVEL_SHAPES[arrays.shape[1:]]
+
+    if mode == 'packed':
+        if arrays.dtype != np.uint8:
+            raise TypeError("Error: argument `arrays` must have uint8 elements when packed")
+    else:
+        cells = arrays[:, :64] if mode == 'array' else arrays
+        if mode == 'tensor':
+            min_value, max_value = -2, 2
+        else:
+            min_value, max_value = MIN_ARRAY_LEGAL_VALUE, MAX_ARRAY_LEGAL_VALUE
+        if cells.size and (cells.min() < min_value or cells.max() > max_value):
+            raise ValueError(f"Error: the boards of argument `arrays` cannot have values outside the "
+                             f"range [{min_value},{max_value}]")
+
+    if mode == 'array':
+        info = arrays[:, 64:]
+    elif mode == 'packed':
+        info = _from_packed(arrays)[1]
+    elif info is None:
+        info = np.tile(np.array([1, 0, 0]), (len(arrays), 1))
+    if type(info) is not np.ndarray:
+        raise TypeError("Error: argument `info` must be either None or a numpy ndarray")
+    if info.shape != (len(arrays), 3):
+        raise RuntimeError("Error: argument `info` must be either None or have shape (N, 3)")
+    if not np.issubdtype(info.dtype, np.integer):
+        raise TypeError("Error: argument `info` must be either None or have integer elements")
+    if info.size and (info.min() < MIN_INFO_LEGAL_VALUE or info.max() > MAX_INFO_LEGAL_VALUE):
+        raise ValueError("Error: argument `info` must be either None or have values "
+                         f"in the range [{MIN_INFO_LEGAL_VALUE},{MAX_INFO_LEGAL_VALUE}]")
+    return arrays, info, mode
+
+
 class BoardArray(chess.Board):
     def __init__(self, *args, low_level: tuple = None, **kwargs):
         if low_level is not None:
-            castling = ""
-            enpassant = None
-
             array, additional_info, mode = validate_low_level_arg(low_level)
 
-            if mode == 'tensor':
-                for i in range(64):
-                    # set castling possibility
-                    if np.array(array[CHANNEL_DICTIONARY['r']]).flatten()[i] in [2, -2]:
-                        castling += CASTLING_INDICES[i]
-                    # set enpassant possibility
-                    if np.array(array[CHANNEL_DICTIONARY['p']]).flatten()[i] in [2, -2]:
-                        s = 1 if i < 32 else -1
-                        enpassant = i - s * 8
-
-                array[array == 2] = 1
-                array[array == -2] = -1
-
-                for i in range(6):
-                    array[i][array[i] == 1] = i + 1 + OFFSET_COLOR
-                    array[i][array[i] == -1] = i + 1
-                array = np.sum(array, axis=0)
-                array = array.flatten()
-                cells_dict = {i: chess.Piece(*v) for i, v in enumerate(
-                    map(lambda x: (x, False)
-                        if x <= OFFSET_COLOR
-                        else (x - OFFSET_COLOR, True), array[:64]))}
-
-            else:
-                if mode == 'matrix':
-                    array = array.flatten()
-
-                for i in range(64):
-                    if OFFSET_CASTLING < array[i] < OFFSET_ENPASSANT:
-                        array[i] = array[i] - OFFSET_CASTLING
-                        castling += CASTLING_INDICES[i]
-
-                    if array[i] > OFFSET_ENPASSANT:
-                        array[i] = array[i] - OFFSET_ENPASSANT
-                        s = 1 if i < 32 else -1
-                        enpassant = i - s * 8
-
-                cells_dict = {i: chess.Piece(*v) for i, v in enumerate(
-                    map(lambda x: (x, False)
-                        if x <= OFFSET_COLOR
-                        else (x - OFFSET_COLOR, True), array[:64]))}
-
             super().__init__(*args, **kwargs)
-            self.set_piece_map(cells_dict)
-            self.set_castling_fen(''.join(sorted(castling)))
-            self.ep_square = enpassant
-
-            self.turn = bool(additional_info[0])
-            self.halfmove_clock = additional_info[1]
-            self.fullmove_number = additional_info[2]
+            masks = _decode_bitboards(array[np.newaxis], mode)[0]
+            _set_bitboards(self, masks.tolist(), additional_info.tolist())
         else:
             super().__init__(*args, **kwargs)
 
-    def to_low_level(self, mode='array', additional_info=False) -> tuple[np.ndarray, np.ndarray]:
-        modes = ['array', 'matrix', 'tensor']
-        if mode not in modes:
-            raise ValueError(f"Error: argument mode must be one of {modes}")
-        cells = str(self).split()
-        # flip each row to restore the correct cell ordering
-        for i in range(8):
-            cells[i * 8:i * 8 + 8] = cells[i * 8:i * 8 + 8][::-1]
-
-        # True if w, False if b
-        turn = str(self.fen()).split()[1]
-        half_move = str(self.fen()).split()[4]
-        full_move = str(self.fen()).split()[5]
-
+    def to_low_level(self, mode='array', additional_info=False, dtype=int) -> tuple[np.ndarray, np.ndarray]:
+        """
+        :param mode: representation of the board ['array', 'matrix', 'tensor', 'packed']
+        :param additional_info: if True, also return the additional info (turn, half moves, full moves), which is
+        None in 'array' and 'packed' mode since they already contain it
+        :param dtype: integer type of the encoding, e.g. np.int8 to save memory ('tensor' mode needs a signed type).
+        The 'packed' encoding is always np.uint8
+        """
+        if mode not in LOW_LEVEL_MODES:
+            raise ValueError(f"Error: argument mode must be one of {LOW_LEVEL_MODES}")
+        dtype = _validate_dtype(mode, dtype)
+
+        masks = np.array([_bitboards(self)], dtype=np.uint64)
         # additional state information
-        additional = np.array([TURN_DICTIONARY[turn], int(half_move), int(full_move)])
+        additional = np.array([[int(self.turn), self.halfmove_clock, self.fullmove_number]])
+        arr, additional = _encode_bitboards(masks, additional, mode, dtype)
 
-        if mode == 'tensor':
-            arr = np.zeros((6, 8, 8), dtype=int)
-            for i in range(64):
-                ch = cells[i]
-                if ch == '.':
-                    continue
-                if ch == ch.lower():
-                    # black
-                    n = -1
-                else:
-                    # white
-                    n = 1
-                    ch = ch.lower()
-                arr[CHANNEL_DICTIONARY[ch], 7 - (i // 8), 7 - (i % 8)] = n
-
-            castling = str(self.fen()).split()[2]
-
-            for ch in "kqKQ":
-                if ch in castling:
-                    i = REVERSE_CASTLING_INDICES[ch] // 8
-                    j = REVERSE_CASTLING_INDICES[ch] % 8
-                    k = CHANNEL_DICTIONARY['r']
-                    arr[k, i, j] *= 2
-
-            if self.ep_square is not None:
-                s = 1 if self.ep_square < 32 else -1
-                n = self.ep_square + s * 8
-                i = n // 8
-                j = n % 8
-                k = CHANNEL_DICTIONARY['p']
-                arr[k, i, j] *= 2
-
-        else:
-            cells_encoding = np.array(list(map(lambda x: DICTIONARY[x], reversed(cells))))
-            castling = str(self.fen()).split()[2]
-
-            if 'k' in castling:
-                cells_encoding[63] += OFFSET_CASTLING
-            if 'q' in castling:
-                cells_encoding[56] += OFFSET_CASTLING
-            if 'K' in castling:
-                cells_encoding[7] += OFFSET_CASTLING
-            if 'Q' in castling:
-                cells_encoding[0] += OFFSET_CASTLING
-
-            if self.ep_square is not None:
-                # compute offset for target ep square based on current player
-                s = 1 if self.ep_square < 32 else -1
-
-                cells_encoding[self.ep_square + s * 8] += OFFSET_ENPASSANT
-
-            if mode == 'array':
-                arr = np.concatenate((cells_encoding, additional))
-                additional = None
-            else:
-                arr = cells_encoding.reshape((8, 8))
         if additional_info:
-            return arr, additional
+            return arr[0], None if additional is None else additional[0]
         else:
-            return arr
-
-
+            return arr[0]
+
+
+def encode_batch(boards: Sequence[chess.Board], mode='array', additional_info=False,
+                 dtype=int) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Encode a sequence of boards at once, with the same layout of `BoardArray.to_low_level`.
+    The bitboards of all the boards are collected in a single buffer and unpacked together.
+
+    :param boards: the boards to be encoded
+    :param mode: representation of the boards ['array', 'matrix', 'tensor', 'packed']
+    :param additional_info: if True, also return the (N, 3) additional info (turn, half moves, full moves)
+    :param dtype: integer type of the encoding, see `BoardArray.to_low_level`
+    :return: an array of shape (N, 67), (N, 8, 8), (N, 6, 8, 8) or (N, PACKED_SIZE), and the additional info if
+    requested
+    """
+    if mode not in LOW_LEVEL_MODES:
+        raise ValueError(f"Error: argument mode must be one of {LOW_LEVEL_MODES}")
+    dtype = _validate_dtype(mode, dtype)
+    n = len(boards)
+    masks = np.fromiter(itertools.chain.from_iterable(_bitboards(b) for b in boards),
+                        dtype=np.uint64, count=n * N_BITBOARDS).reshape(n, N_BITBOARDS)
+    additional = np.fromiter(itertools.chain.from_iterable((int(b.turn), b.halfmove_clock, b.fullmove_number)
+                                                           for b in boards),
+                             dtype=int, count=n * 3).reshape(n, 3)
+    arr, additional = _encode_bitboards(masks, additional, mode, dtype)
+
+    if additional_info:
+        return arr, additional
+    else:
+        return arr
+
+
+def encode_game(moves: Iterable[chess.Move], board: chess.Board = None, mode='tensor', additional_info=False,
+                dtype=int) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Encode all the positions of a game incrementally: starting from the bitboards of @board, each move only updates
+    the few squares it touches (captures, castling rooks, en passant and promotions included), so that no position
+    is ever rebuilt from scratch. The moves are assumed to be legal, as the ones of a game taken from the database.
+
+    :param moves: the moves of the game, e.g. `game.mainline_moves()`
+    :param board: the position before the first move, the standard starting position if None
+    :param mode: representation of the boards ['array', 'matrix', 'tensor', 'packed']
+    :param additional_info: if True, also return the (N + 1, 3) additional info (turn, half moves, full moves)
+    :param dtype: integer type of the encoding, see `BoardArray.to_low_level`
+    :return: an array with the N + 1 positions of a game of N moves (the first one is @board), so that the states
+    (s_t, s_t+1) are the rows t and t + 1, and the additional info if requested
+    """
+    if mode not in LOW_LEVEL_MODES:
+        raise ValueError(f"Error: argument mode must be one of {LOW_LEVEL_MODES}")
+    dtype = _validate_dtype(mode, dtype)
+    board = chess.Board() if board is None else board
+
+    masks = _bitboards(board)
+    # index of the bitboard of the piece on each square, -1 if empty
+    mailbox = [-1] * 64
+    for k in range(2 * OFFSET_COLOR):
+        for square in chess.scan_forward(masks[k]):
+            mailbox[square] = k
+    turn, half_move, full_move = board.turn, board.halfmove_clock, board.fullmove_number
+    rows = list(masks)
+    additional = [int(turn), half_move, full_move]
+
+    for move in moves:
+        half_move += 1
+        enpassant = chess.BB_EMPTY
+        if move:
+            from_square, to_square = move.from_square, move.to_square
+            k = mailbox[from_square]
+            captured = mailbox[to_square]
+            piece_type = k % OFFSET_COLOR + 1
+            masks[k] ^= chess.BB_SQUARES[from_square]
+            mailbox[from_square] = -1
+            masks[12] &= ~(chess.BB_SQUARES[from_square] | chess.BB_SQUARES[to_square])
+
+            if piece_type == chess.KING:
+                masks[12] &= ~(chess.BB_RANK_1 if turn == chess.WHITE else chess.BB_RANK_8)
+
+            if piece_type == chess.KING and (abs(to_square - from_square) == 2 or
+                                             captured != -1 and captured // OFFSET_COLOR == k // OFFSET_COLOR):
+                # castling, either as e1g1 or as the king taking its own rook (e1h1)
+                rank = from_square & 56
+                if chess.square_file(to_square) > chess.square_file(from_square):
+                    rook_from, rook_to, to_square = rank + 7, rank + 5, rank + 6
+                else:
+                    rook_from, rook_to, to_square = rank, rank + 3, rank + 2
+                rook = k - (chess.KING - chess.ROOK)
+                masks[rook] ^= chess.BB_SQUARES[rook_from] | chess.BB_SQUARES[rook_to]
+                mailbox[rook_from], mailbox[rook_to] = -1, rook
+            else:
+                if captured != -1:
+                    masks[captured] ^= chess.BB_SQUARES[to_square]
+                    half_move = 0
+                if piece_type == chess.PAWN:
+                    half_move = 0
+                    if abs(to_square - from_square) == 16:
+                        enpassant = chess.BB_SQUARES[to_square]
+                    elif captured == -1 and chess.square_file(to_square) != chess.square_file(from_square):
+                        # en passant capture: the captured pawn is beside the pawn that moved
+                        victim = chess.square(chess.square_file(to_square), chess.square_rank(from_square))
+                        masks[mailbox[victim]] ^= chess.BB_SQUARES[victim]
+                        mailbox[victim] = -1
+                    if move.promotion:
+                        k = k - piece_type + move.promotion
+
+            masks[k] ^= chess.BB_SQUARES[to_square]
+            mailbox[to_square] = k
+        masks[13] = enpassant
+
+        turn = not turn
+        if turn == chess.WHITE:
+            full_move += 1
+        rows.extend(masks)
+        additional.extend((int(turn), half_move, full_move))
+
+    n = len(rows) // N_BITBOARDS
+    arr, additional = _encode_bitboards(np.array(rows, dtype=np.uint64).reshape(n, N_BITBOARDS),
+                                        np.array(additional).reshape(n, 3), mode, dtype)
+    if additional_info:
+        return arr, additional
+    else:
+        return arr
+
+
+def unpack_batch(packed: np.ndarray, mode='tensor', additional_info=False,
+                 dtype=np.int8) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Expand a batch of boards in 'packed' mode into the @mode encoding, without going through chess.Board objects.
+    This is meant to run on the training side, on data stored or transferred in 'packed' mode.
+
+    :param packed: the (N, PACKED_SIZE) uint8 packed boards
+    :param mode: representation of the boards ['array', 'matrix', 'tensor']
+    :param additional_info: if True, also return the (N, 3) additional info (turn, half moves, full moves)
+    :param dtype: integer type of the encoding, see `BoardArray.to_low_level`
+    :return: an array of shape (N, 67), (N, 8, 8) or (N, 6, 8, 8), and the additional info if requested
+    """
+    if mode not in LOW_LEVEL_MODES:
+        raise ValueError(f"Error: argument mode must be one of {LOW_LEVEL_MODES}")
+    dtype = _validate_dtype(mode, dtype)
+    arr, additional = _encode_bitboards(*_from_packed(packed), mode, dtype)
+
+    if additional_info:
+        return arr, additional
+    else:
+        return arr
+
+
+def decode_batch(arrays: np.ndarray, info: np.ndarray = None, output_in_fen: bool = False,
+                 trusted: bool = False) -> list[BoardArray] | list[str]:
+    """
+    Decode a batch of boards encoded with `encode_batch` (or `BoardArray.to_low_level`) in a single vectorized pass.
+
+    :param arrays: the encoded boards, with shape (N, 67), (N, 8, 8), (N, 6, 8, 8) or (N, PACKED_SIZE)
+    :param info: None or the (N, 3) additional info of each board, ignored in 'array' and 'packed' mode
+    :param output_in_fen: if True, return the fen of each board instead of the board
+    :param trusted: if True, skip the validation of the arguments (e.g. for arrays built by `encode_batch`)
+    :return: the list of decoded boards (or fens)
+    """
+    if trusted:
+        mode = LOW_LEVEL_SHAPES[arrays.shape[1:]]
+        if mode == 'array':
+            info = arrays[:, 64:]
+        elif mode == 'packed':
+            info = _from_packed(arrays)[1]
+        elif info is None:
+            info = np.tile(np.array([1, 0, 0]), (len(arrays), 1))
+    else:
+        arrays, info, mode = validate_low_level_batch(arrays, info)
+
+    masks = _decode_bitboards(arrays, mode)
+    boards = []
+    for board_masks, board_info in zip(masks.tolist(), info.tolist()):
+        board = BoardArray(None)
+        _set_bitboards(board, board_masks, board_info)
+        boards.append(board)
+    if output_in_fen:
+        return [board.fen() for board in boards]
+    return boards
+
+
+def mirror_batch(arrays: np.ndarray, mode: str, info: np.ndarray = None) -> np.ndarray | tuple[np.ndarray, np.ndarray]:
+    """
+    Mirror a batch of encoded boards as `chess.Board.mirror` does: the board is flipped vertically and the colours
+    are swapped, together with the turn, the castling rights and the en passant pawn. Each encoding is mirrored with
+    a precomputed permutation (and value table), without decoding the boards.
+
+    :param arrays: the encoded boards in @mode, with any number of leading dimensions (e.g. a (N, 1, 8, 8) batch)
+    :param mode: representation of the boards ['array', 'matrix', 'tensor', 'packed']
+    :param info: None or the additional info of the boards in 'matrix' and 'tensor' mode, whose turn is swapped
+    :return: the mirrored boards, and the mirrored additional info if @info is not None
+    """
+    if mode == 'packed':
+        arr = arrays[..., PACKED_MIRROR]
+        # the turn is the low byte of the first additional info
+        arr[..., N_BITBOARDS * 8] ^= 1
+    elif mode == 'tensor':
+        arr = -arrays[..., ::-1, :]
+    elif mode == 'matrix':
+        arr = CELL_MIRROR[arrays[..., ::-1, :]].astype(arrays.dtype)
+    elif mode == 'array':
+        arr = arrays[..., ARRAY_MIRROR]
+        arr[..., :64] = CELL_MIRROR[arr[..., :64]]
+        arr[..., 64] = 1 - arr[..., 64]
+    else:
+        raise ValueError(f"Error: argument mode must be one of {LOW_LEVEL_MODES}")
+    if info is not None:
+        info = info.copy()
+        info[..., 0] = 1 - info[..., 0]
+        return arr, info
+    return arr
@@ -1,33 +1,224 @@
+import contextlib
 import datetime
+import os
+import queue
+import threading
 
 import tqdm
 
 import games_from_dataset as gd
+import torch.distributed as dist
 import torch.optim
 import torch.utils.data as data
 import tqdm
+from torch.nn.parallel import DistributedDataParallel
+from utils.utils import is_main_process
+from utils.utils_checkpoint import CheckpointManager, new_run_directory
 from utils.utils_model import *
 import wandb
 import time
 
+# default number of steps between two copies of the running metrics from the device
+SYNC_STEPS = 50
+# default number of batches staged on the device in advance by PrefetchLoader
+PREFETCH_BATCHES = 2
+
+
+def get_inputs(b1: torch.Tensor, b2: torch.Tensor, device, dtype=torch.float32,
+               channels_last: bool = False) -> tuple[torch.Tensor, torch.Tensor]:
+    """
+    Move the boards to @device as @dtype. The integer boards are copied as they are and cast on the device: the copy is
+    the smallest one, and it does not block the host when the batch is in pinned memory (a cast on the host would
+    copy from a new pageable tensor).
+    """
+    memory_format = torch.channels_last if channels_last and b1.dim() == 4 else torch.contiguous_format
+    return tuple(b.to(device, non_blocking=True).to(dtype, memory_format=memory_format) for b in (b1, b2))
+
+
+def get_execution(config) -> tuple[torch.dtype, torch.dtype, bool, bool]:
+    """
+    Execution switches of exp_args: autocast dtype (None for fp32), dtype of the inputs, compile and channels last.
+    """
+    exp_args = config['exp_args']
+    autocast_dtype = get_precision(exp_args.get('precision', 'fp32'))
+    input_dtype = autocast_dtype if autocast_dtype is not None else torch.float32
+    return autocast_dtype, input_dtype, exp_args.get('compile', False), exp_args.get('channels_last', False)
+
+
+def autocast(device, dtype):
+    return torch.autocast(device_type=torch.device(device).type, dtype=dtype, enabled=dtype is not None)
+
+
+def get_target(action_gt: torch.Tensor, device) -> tuple[torch.Tensor, torch.Tensor]:
+    """
+    Move the ground truth to @device and return it in the form expected by the loss, along with the action indices.
+    Class indices are used as they are, one hot vectors (e.g. for the mse loss) are cast to float.
+    """
+    action_gt = action_gt.to(device, non_blocking=True)
+    if action_gt.dim() == 1:
+        action_gt = action_gt.long()
+        return action_gt, action_gt
+    return action_gt.float(), torch.argmax(action_gt, axis=-1)
+
+
+def _tensors(batch):
+    # tensors of a (nested) tuple batch
+    if isinstance(batch, torch.Tensor):
+        yield batch
+    elif isinstance(batch, (tuple, list)):
+        for item in batch:
+            yield from _tensors(item)
+
+
+class PrefetchLoader:
+
+    def __init__(self, loader: data.DataLoader, transfer: callable, device, depth: int = PREFETCH_BATCHES):
+        """
+        Iterate @loader on a background thread, which applies @transfer to the next @depth batches (e.g. moving them to
+        @device) while the current one is used. On cuda the copies are issued on a side stream, they do not block the
+        host if the DataLoader pins the batches (see `get_dataloader`).
+        The time spent by the consumer waiting for the batches in the last iteration is in `wait_time`.
+        :param loader: the DataLoader, iterated once by each iteration of the wrapper
+        :param transfer: function from a batch of @loader to the batch to be yielded
+        :param device: device of the yielded batches
+        :param depth: batches staged in advance, set to 0 to transfer the batches on the consumer thread
+        """
+        self.loader = loader
+        self.transfer = transfer
+        self.device = torch.device(device)
+        self.depth = depth
+        self.wait_time = 0.0
+
+    def __len__(self):
+        return len(self.loader)
+
+    def _stage(self, staged: queue.Queue, stop: threading.Event):
+        def put(item) -> bool:
+            # False if the consumer stopped the iteration
+            while not stop.is_set():
+                try:
+                    staged.put(item, timeout=0.1)
+                    return True
+                except queue.Full:
+                    pass
+            return False
+
+        stream = torch.cuda.Stream(self.device) if self.device.type == 'cuda' else None
+        try:
+            with torch.cuda.stream(stream) if stream is not None else contextlib.nullcontext():
+                for batch in self.loader:
+                    batch = self.transfer(batch)
+                    event = None
+                    if stream is not None:
+                        event = torch.cuda.Event()
+                        event.record(stream)
+                    if not put((batch, event, None)):
+                        return
+        except Exception as e:
+            put((None, None, e))
+            return
+        put(None)
+
+    def __iter__(self):
+        self.wait_time = 0.0
+        if self.depth <= 0:
+            batches = iter(self.loader)
+            while True:
+                t = time.perf_counter()
+                batch = next(batches, None)
+                if batch is None:
+                    return
+                batch = self.transfer(batch)
+                self.wait_time += time.perf_counter() - t
+                yield batch
+        staged = queue.Queue(maxsize=self.depth)
+        stop = threading.Event()
+        thread = threading.Thread(target=self._stage, args=(staged, stop), daemon=True)
+        thread.start()
+        try:
+            while True:
+                t = time.perf_counter()
+                item = staged.get()
+                self.wait_time += time.perf_counter() - t
+                if item is None:
+                    return
+                batch, event, error = item
+                if error is not None:
+                    raise error
+                if event is not None:
+                    # the batch is used on the current stream, its memory must not be reused before that
+                    current = torch.cuda.current_stream(self.device)
+                    current.wait_event(event)
+                    for tensor in _tensors(batch):
+                        tensor.record_stream(current)
+                yield batch
+        finally:
+            stop.set()
+            thread.join()
+
+
+class MetricsAccumulator:
+
+    def __init__(self, device, sync_every: int = SYNC_STEPS):
+        """
+        Running sums of the loss and of the correct predictions, kept as tensors on @device: accumulating them does
+        not wait for the device, as calling .item() at each step would. They are copied to the host only by
+        `snapshot`, which is meant to be called when `due` (every @sync_every steps) and at the end of the epoch.
+        :param device: device of the model outputs
+        :param sync_every: steps between two snapshots
+        """
+        self.loss = torch.zeros((), device=device)
+        # exact count, a float32 would lose precision above 2^24 samples
+        self.corrects = torch.zeros((), dtype=torch.int64, device=device)
+        self.samples = 0
+        self.steps = 0
+        self.sync_every = sync_every
+
+    def update(self, loss: torch.Tensor, predicted: torch.Tensor, gt: torch.Tensor):
+        self.loss += loss.detach()
+        self.corrects += torch.sum(predicted == gt)
+        self.samples += gt.shape[0]
+        self.steps += 1
+
+    def due(self) -> bool:
+        return self.steps % self.sync_every == 0
+
+    def snapshot(self, reduce: bool = False) -> tuple[float, float, float]:
+        """
+        Copy the metrics to the host, with a single synchronization.
+        :param reduce: sum the metrics of all the processes of a distributed job. Every process must call it
+        :return: the accuracy in percentage, the average loss of the steps and the sum of the losses
+        """
+        if reduce and dist.is_available() and dist.is_initialized():
+            metrics = torch.stack([self.loss.double(), self.corrects.double(),
+                                   torch.tensor(float(self.samples), device=self.loss.device),
+                                   torch.tensor(float(self.steps), device=self.loss.device)])
+            dist.all_reduce(metrics)
+            tot_loss, corrects, samples, steps = metrics.tolist()
+        else:
+            tot_loss, corrects = torch.stack([self.loss.double(), self.corrects.double()]).tolist()
+            samples, steps = self.samples, self.steps
+        return corrects / max(samples, 1) * 100, tot_loss / max(steps, 1), tot_loss
+
 
 @torch.no_grad()
 def test(model: nn.Module, test_data: data.DataLoader, config, logger):
     device = config['setup_args']['device']
+    autocast_dtype, input_dtype, compile, channels_last = get_execution(config)
+    # a module already compiled (e.g. the one returned by `train`) is used as it is
+    model = prepare_model(model, device, compile, channels_last)
     loss_func = get_loss_func(config['exp_args']['loss'])
-    corrects = 0
-    totals = 0
-    tot_loss = 0.0
-    for (b1, b2), move_gt in test_data:
-        b1, b2, move_gt = b1.to(device).float(), b2.to(device).float(), move_gt.to(device).float()
-        move = model(b1, b2)
+    metrics = MetricsAccumulator(device)
+    test_data = PrefetchLoader(test_data, lambda batch: (get_inputs(*batch[0], device, input_dtype, channels_last),
+                                                         get_target(batch[1], device)),
+                               device, config['data_loader'].get('prefetch_batches', PREFETCH_BATCHES))
+    for (b1, b2), (move_gt, gt) in test_data:
+        with autocast(device, autocast_dtype):
+            move = model(b1, b2)
+            loss = loss_func(move, move_gt)
         predicted_move = torch.argmax(move, axis=-1)
-        gt = torch.argmax(move_gt, axis=-1)
-        corrects += torch.sum(predicted_move == gt)
-        totals += predicted_move.shape[0]
-        tot_loss += loss_func(move, move_gt).item()
-    accuracy = (corrects/totals).detach().cpu().numpy()*100
-    avg_loss = tot_loss / len(test_data)
+        metrics.update(loss, predicted_move, gt)
+    accuracy, avg_loss, _ = metrics.snapshot(reduce=True)
     if logger is not None:
         logger.info(f"\nEval accuracy {accuracy:.2f}%, Eval avg loss {avg_loss:.5f}")
         wandb.log({"Eval accuracy": accuracy, "Eval avg loss": avg_loss})
@@ -35,85 +226,134 @@ def test(model: nn.Module, test_data: data.DataLoader, config, logger):
 
 
 def train(model: nn.Module, train_data: data.DataLoader, val_data: data.DataLoader, config, logger):
+    autocast_dtype, input_dtype, compile, channels_last = get_execution(config)
     # check if there is a model to be resumed
     if config['setup_args']['resume']:
         try:
             pt_file = config['setup_args']['resume_path']
-            checkpoint = torch.load(pt_file)
+            checkpoint = torch.load(pt_file, map_location=config['setup_args']['device'])
         except FileNotFoundError as e1:
             print(f"File path incorrect or null: {config['setup_args']['resume_path']}")
             raise e1
         except TypeError as e2:
             print(f"File path is not a string: {type(config['setup_args']['resume_path'])}")
             raise e2
-        print('Resume Training')
+        if is_main_process():
+            print('Resume Training')
         device = config['setup_args']['device']
         model = model.to(device)
         model.load_state_dict(checkpoint['model_state_dict'])
+        scaler_state = checkpoint.get('scaler_state_dict')
         optim = get_optimizer(model, config['exp_args']['optimizer'].lower(), config['exp_args']['lr'])
         optim.load_state_dict(checkpoint['optimizer_state_dict'])
         sched = get_scheduler(optim, type=config['exp_args']['scheduler'])
         sched.load_state_dict(checkpoint['scheduler_state_dict'])
         loss_func = get_loss_func(config['exp_args']['loss'])
-        init_epoch = checkpoint['epoch'] + 1
+        # position of the data loader, the epoch after the one of the checkpoint for the older ones
+        loader_state = checkpoint.get('loader_state', {'epoch': checkpoint['epoch'] + 1, 'step': 0})
+        init_epoch, step = loader_state['epoch'], loader_state['step']
+        # the run goes on in the directory of the checkpoint
+        checkpoint_dir = os.path.dirname(os.path.abspath(pt_file))
+        best_metric = checkpoint.get('best_metric')
 
     else:
-        print('Start Training')
-        pt_file = datetime.datetime.now().strftime("./models/%Y-%m-%d-%H-%M") + ".pt"
+        if is_main_process():
+            print('Start Training')
+        # created by the process saving the checkpoints
+        checkpoint_dir = None
         device = config['setup_args']['device']
         model = model.to(device)
         optim = get_optimizer(model, config['exp_args']['optimizer'].lower(), config['exp_args']['lr'])
         sched = get_scheduler(optim, type=config['exp_args']['scheduler'])
         loss_func = get_loss_func(config['exp_args']['loss'])
-        init_epoch = 0
+        init_epoch, step = 0, 0
+        best_metric = None
+        scaler_state = None
+
+    # fp16 gradients can underflow, they are scaled (bf16 has the range of fp32)
+    scaler = torch.amp.GradScaler(torch.device(device).type, enabled=autocast_dtype == torch.float16)
+    if scaler_state is not None:
+        scaler.load_state_dict(scaler_state)
+    # the compiled module shares the parameters of model, which is the one saved in the checkpoints
+    net = prepare_model(model, device, compile, channels_last)
+    # in a distributed job (see utils.init_distributed) the gradients are averaged among the processes by ddp, which
+    # is used only for the training steps: the evaluation runs the local copy of the model
+    distributed = dist.is_available() and dist.is_initialized()
+    ddp = DistributedDataParallel(net) if distributed else net
+    # the streamed splits can have a different number of batches on each process
+    uneven = distributed and isinstance(train_data.dataset, gd.StreamingMoveDataset)
+    # the next batches are moved to the device while the current one is used
+    train_loader = PrefetchLoader(train_data, lambda batch: (get_inputs(*batch[0], device, input_dtype, channels_last),
+                                                             get_target(batch[1], device)),
+                                  device, config['data_loader'].get('prefetch_batches', PREFETCH_BATCHES))
+
+    # the checkpoints are written in background, the training goes on while they are saved
+    checkpoints = None
+    if is_main_process():
+        if checkpoint_dir is None:
+            checkpoint_dir = new_run_directory(config['setup_args'].get('checkpoint_dir', './models'),
+                                               datetime.datetime.now().strftime("%Y-%m-%d-%H-%M-%S"))
+        checkpoints = CheckpointManager(checkpoint_dir, keep_last=config['setup_args'].get('keep_last', 3),
+                                        best=best_metric)
 
     if logger is not None:
         logger.info('\nStart Training')
 
     for epoch in range(init_epoch, config['exp_args']['epoch']):
         t = time.time()
-        tot_loss = 0.0
-        corrects = 0
-        totals = 0
-        loss = torch.tensor(0.0)
+        metrics = MetricsAccumulator(device, config['exp_args'].get('sync_steps', SYNC_STEPS))
+        if isinstance(train_data.dataset, gd.StreamingMoveDataset):
+            train_data.dataset.set_epoch(epoch)
+        if isinstance(train_data.sampler, (data.DistributedSampler, gd.DistributedWeightedSampler)):
+            train_data.sampler.set_epoch(epoch)
         # TODO: handling repetition of games if data is resumed by checkpoint
-        data_iterator = tqdm.tqdm(train_data)
-        for (b1, b2), action_gt in data_iterator:
-            data_iterator.set_description(f'Training epoch {epoch}, training loss {loss.item():5f}')
-            b1, b2 = b1.to(device).float(), b2.to(device).float()
-            action_gt = action_gt.to(device).float()
-            optim.zero_grad()
-            action = model(b1, b2)
-            loss = loss_func(action, action_gt)
-            loss.backward()
-            optim.step()
-            tot_loss += loss.item()
-            predicted_move = torch.argmax(action, axis=-1)
-            gt = torch.argmax(action_gt, axis=-1)
-            corrects += torch.sum(predicted_move == gt)
-            totals += predicted_move.shape[0]
+        data_iterator = tqdm.tqdm(train_loader, disable=not is_main_process())
+        data_iterator.set_description(f'Training epoch {epoch}')
+        with ddp.join() if uneven else contextlib.nullcontext():
+            for (b1, b2), (action_gt, gt) in data_iterator:
+                optim.zero_grad()
+                with autocast(device, autocast_dtype):
+                    action = ddp(b1, b2)
+                    loss = loss_func(action, action_gt)
+                scaler.scale(loss).backward()
+                scaler.step(optim)
+                scaler.update()
+                step += 1
+                predicted_move = torch.argmax(action, axis=-1)
+                metrics.update(loss, predicted_move, gt)
+                if metrics.due():
+                    # progress of this process only, the metrics of the epoch are reduced among all of them
+                    _, avg_loss, _ = metrics.snapshot()
+                    data_iterator.set_description(f'Training epoch {epoch}, training loss {avg_loss:5f}')
         sched.step()
+        accuracy, avg_loss, tot_loss = metrics.snapshot(reduce=True)
         t = time.time() - t
-        accuracy = (corrects / totals).detach().cpu().numpy()*100
-        avg_loss = tot_loss / len(train_data)
+        # time the training steps waited for the batches: if it is a large part of the epoch, the input pipeline is
+        # the bottleneck (more workers, a larger prefetch)
+        data_wait = train_loader.wait_time
         if logger is not None:
-            logger.info(f"\nEpoch {epoch}: Train avg loss  {loss:.5f}, "
-                        f"Train accuracy {accuracy:.2f}%, Time required: {t:.2f}s")
+            logger.info(f"\nEpoch {epoch}: Train avg loss  {avg_loss:.5f}, "
+                        f"Train accuracy {accuracy:.2f}%, Time required: {t:.2f}s, "
+                        f"Data wait: {data_wait:.2f}s ({data_wait / t * 100:.1f}%)")
             wandb.log({"Epoch": epoch, "Train avg loss":  avg_loss,
-                       "Train accuracy": accuracy, "Time": t})
+                       "Train accuracy": accuracy, "Time": t, "Data wait": data_wait})
         if epoch % config['exp_args']['eval_step'] == 0:
-            eval_stats, _ = test(model, val_data, config, logger)
-            print(f"Eval accuracy {eval_stats}")
-            # checkpoint and saving of model parameters, optimizer, scheduler
-            f = open(pt_file, "w")
-            torch.save({'epoch': epoch,
-                        'model_state_dict': model.state_dict(),
-                        'optimizer_state_dict': optim.state_dict(),
-                        'scheduler_state_dict': sched.state_dict(),
-                        'loss': tot_loss,
-                        }, pt_file)
-            f.close()
-
-    return model
+            eval_accuracy, eval_loss = test(net, val_data, config, logger)
+            if not is_main_process():
+                continue
+            print(f"Eval accuracy {eval_accuracy}")
+            # checkpoint of model parameters, optimizer, scheduler and data loader position, the best one is the one
+            # with the lowest validation loss
+            checkpoints.save({'model_state_dict': model.state_dict(),
+                              'optimizer_state_dict': optim.state_dict(),
+                              'scheduler_state_dict': sched.state_dict(),
+                              'scaler_state_dict': scaler.state_dict(),
+                              'loader_state': {'epoch': epoch + 1, 'step': step},
+                              'loss': tot_loss,
+                              }, epoch, metric=eval_loss)
+
+    if checkpoints is not None:
+        checkpoints.close()
+    return net
 
 
@@ -1,18 +1,92 @@
+import ast
+import collections.abc
+import operator
+import copy
 import datetime
+import functools
+import hashlib
+import io
 import itertools
+import json
+import logging
+import multiprocessing
 import os.path
-import pickle
+import random
+import re
+import shutil
+import tempfile
+import time
+import zipfile
+
+try:
+    import fcntl
+except ImportError:
+    # no file locks (e.g. on Windows, where the files in use cannot be removed anyway)
+    fcntl = None
 
 import chess
 import chess.pgn
+import chess.polyglot
 import numpy as np
+import torch
+import torch.distributed as dist
 import torch.utils.data as data
 import tqdm
 
-from boardarray import BoardArray
+from actionspace import ACTION_SPACE_SIZE, MIRROR_INDEX, MOVE_TO_INDEX, encode_move, index_to_move, move_to_index
+from boardarray import PACKED_SIZE, decode_batch, encode_game, mirror_batch, unpack_batch
 from constants import PROJECT_PATH
 
 FILENAME = "data/dataset.pgn"
+# move transforms that can be passed by name: the action space index (class target for the cross entropy loss)
+# or its one hot vector (e.g. for the mse loss)
+MOVE_TRANSFORMS = {'index': move_to_index, 'one_hot': encode_move}
+# approximate size in bytes of the pieces of pgn file parsed by each task of `parallel_file_parser`
+CHUNK_SIZE = 16 * 2 ** 20
+# directory and size budget in bytes of the cache of the datasets built by `MoveDataset`
+CACHE_DIR = f"{PROJECT_PATH}/data/cache"
+CACHE_SIZE = 8 * 2 ** 30
+# integer type of the decoded samples: int8, the narrowest one, so that the batches are smaller to send from the
+# workers and to copy to the device, except in 'array' mode where int8 would saturate the move counters at 127
+SAMPLE_DTYPES = {'array': np.int16, 'matrix': np.int8, 'tensor': np.int8}
+# version of the layout written by `build_dataset`, datasets with a different version are rebuilt
+DATASET_VERSION = 2
+MANIFEST = "manifest.json"
+# lock file of a cached dataset, held (shared) by the datasets reading it, so that it is not evicted
+LOCK = ".lock"
+# prefix of the directories of the datasets being built, and age in seconds after which a build directory that is not
+# locked by its builder is left over by a crashed build, and removed by `DatasetCache.evict`
+BUILD_PREFIX = ".build-"
+STALE_BUILD = 6 * 3600
+# index of the first sample of each game of a pre-encoded dataset, followed by the number of samples
+GAMES = "games.npy"
+# maximum number of samples in each shard of a pre-encoded dataset
+SHARD_SAMPLES = 2 ** 20
+# plies between two positions stored by `GameStore`, the others are replayed from the previous one
+KEYFRAME_PLIES = 16
+# default number of samples kept in the shuffle buffer of `StreamingMoveDataset`
+SHUFFLE_BUFFER = 2 ** 14
+# games are assigned to the splits of `StreamingMoveDataset` in blocks of SPLIT_GAMES consecutive games
+SPLIT_GAMES = 100
+# headers stored by default in the game index of a pgn file
+INDEX_HEADERS = ('White', 'Black', 'Result', 'WhiteElo', 'BlackElo', 'ECO', 'TimeControl')
+# version of the layout of the game index, indices with a different version are rebuilt
+INDEX_VERSION = 2
+# score of white of each Result header, the other results (e.g. '*') are NaN in the parsed column
+RESULT_SCORES = {'1-0': 1.0, '0-1': 0.0, '1/2-1/2': 0.5}
+
+# operators and functions allowed in the queries of `PgnIndex.select`
+QUERY_OPERATORS = {ast.BitAnd: operator.and_, ast.BitOr: operator.or_, ast.Invert: operator.invert,
+                   ast.Eq: operator.eq, ast.NotEq: operator.ne, ast.Lt: operator.lt, ast.LtE: operator.le,
+                   ast.Gt: operator.gt, ast.GtE: operator.ge, ast.Add: operator.add, ast.Sub: operator.sub,
+                   ast.Mult: operator.mul, ast.Div: operator.truediv, ast.USub: operator.neg}
+QUERY_FUNCTIONS = {'np.char.startswith': np.char.startswith, 'np.char.endswith': np.char.endswith,
+                   'np.isnan': np.isnan, 'abs': np.abs}
+
+_HEADER_RE = re.compile(rb'\[(\w+)\s+"((?:[^"\\]|\\.)*)"\s*\]')
+_COMMENT_RE = re.compile(rb'\{[^}]*\}|;[^\n]*')
+_VARIATION_RE = re.compile(rb'\([^()]*\)')
+_NOT_MOVE_RE = re.compile(rb'\$\d+|\d+\.+|1-0|0-1|1/2-1/2|\*')
 
 
 def file_parser(fname: str = FILENAME) -> chess.pgn.Game:
@@ -26,15 +100,397 @@ def file_parser(fname: str = FILENAME) -> chess.pgn.Game:
     :rtype: chess.pgn.Game
     """
     with open(fname) as f:
-        while True:
+        yield from _read_games(f)
+
+
+def _read_games(f) -> chess.pgn.Game:
+    while True:
+        try:
+            game = chess.pgn.read_game(f)
+            if game:
+                yield game
+            else:
+                return
+        except Exception as e:
+            print(e)
+
+
+def _next_game_start(f, position: int) -> int:
+    # skip the line containing @position, then look for the first header after some movetext
+    f.seek(position)
+    f.readline()
+    seen_movetext = False
+    while True:
+        offset = f.tell()
+        line = f.readline()
+        if not line:
+            return offset
+        if line.startswith(b'['):
+            if seen_movetext:
+                return offset
+        elif line.strip():
+            seen_movetext = True
+
+
+def split_pgn(fname: str = FILENAME, chunk_size: int = CHUNK_SIZE) -> list[tuple[int, int]]:
+    """
+    Split the file @fname in byte ranges of about @chunk_size bytes, each one starting at the beginning of a game.
+
+    :param fname: the name of the pgn dataset file
+    :param chunk_size: approximate size in bytes of each range
+    :return: the list of ranges (start, end), in file order
+    """
+    size = os.path.getsize(fname)
+    starts = [0]
+    with open(fname, 'rb') as f:
+        position = chunk_size
+        while position < size:
+            start = _next_game_start(f, position)
+            if start >= size:
+                break
+            starts.append(start)
+            position = start + chunk_size
+    return list(zip(starts, starts[1:] + [size]))
+
+
+def _parse_range(task: tuple[str, int, int, callable, bool]) -> list:
+    fname, start, end, game_fn, fast = task
+    with open(fname, 'rb') as f:
+        f.seek(start)
+        text = f.read(end - start)
+    games = read_mainlines(io.BytesIO(text), ()) if fast else _read_games(io.StringIO(text.decode()))
+    return [game_fn(game) for game in games]
+
+
+def parallel_file_parser(fname: str = FILENAME, game_fn: callable = None, n_workers: int = None,
+                         chunk_size: int = CHUNK_SIZE, fast: bool = False, ranges: list[tuple[int, int]] = None):
+    """
+    Parallel version of `file_parser`: the file @fname is split in game aligned byte ranges (see `split_pgn`),
+    which are parsed by a pool of processes. Each game is processed by @game_fn inside the worker, and the results
+    are yielded in file order, so the output does not depend on the number of workers.
+
+    :param fname: the name of the pgn dataset file
+    :param game_fn: function applied to each game in the workers, it must be picklable (e.g. defined at module
+    level) and so must be its results. The default `game_states_list` replays the game into its states
+    :param n_workers: number of processes, all the available cpus if None
+    :param chunk_size: approximate size in bytes of the ranges parsed by each task
+    :param fast: if True, read the games with `read_mainlines`, @game_fn then receives a `MainlineGame`
+    :param ranges: game aligned byte ranges of the games to parse (e.g. `PgnIndex.ranges`), `split_pgn` if None
+    :return: the result of @game_fn, one game at a time
+    """
+    game_fn = game_states_list if game_fn is None else game_fn
+    ranges = split_pgn(fname, chunk_size) if ranges is None else ranges
+    tasks = [(fname, start, end, game_fn, fast) for start, end in ranges]
+    with multiprocessing.Pool(n_workers) as pool:
+        for results in pool.imap(_parse_range, tasks):
+            yield from results
+
+
+def _san_tokens(movetext: bytes) -> list[bytes]:
+    # drop comments, (nested) variations, NAGs, move numbers and results: the remaining tokens are the SAN mainline
+    movetext = _COMMENT_RE.sub(b' ', movetext)
+    n = 1
+    while n:
+        movetext, n = _VARIATION_RE.subn(b' ', movetext)
+    return _NOT_MOVE_RE.sub(b' ', movetext).split()
+
+
+def _count_plies(movetext: bytes) -> int:
+    return len(_san_tokens(movetext))
+
+
+class MainlineGame:
+
+    def __init__(self, headers: dict[str, str], movetext: bytes):
+        """
+        Game read by `read_mainlines`: only the requested headers and the moves of the mainline are kept. The moves
+        are parsed when they are first needed, so skipping a game costs nothing. It can be used in place of a
+        chess.pgn.Game by the functions of this module (`game_states`, `encode_game_record`, ...).
+        :param headers: the headers of the game
+        :param movetext: the movetext of the game, as in the pgn file
+        """
+        self.headers = headers
+        self.movetext = movetext
+        self.errors = []
+        self._moves = None
+
+    def board(self) -> chess.Board:
+        """
+        The starting position of the game: the position of the FEN header, if any, or the standard one.
+        """
+        return chess.Board(self.headers['FEN']) if 'FEN' in self.headers else chess.Board()
+
+    def mainline_moves(self) -> list[chess.Move]:
+        """
+        The moves of the mainline. As `chess.pgn.read_game` does, the mainline stops at the first illegal move, and
+        the error is recorded in `errors`.
+        """
+        if self._moves is None:
+            self._moves = []
             try:
-                game = chess.pgn.read_game(f)
-                if game:
-                    yield game
-                else:
-                    return
-            except Exception as e:
-                print(e)
+                board = self.board()
+                for token in _san_tokens(self.movetext):
+                    move = board.parse_san(token.rstrip(b'!?').decode())
+                    board.push(move)
+                    self._moves.append(move)
+            except ValueError as e:
+                self.errors.append(e)
+                logging.warning(f"Error: malformed game {self.headers or self.movetext[:80]}: {e}")
+        return self._moves
+
+
+def read_mainlines(f, headers: tuple[str, ...] = None) -> MainlineGame:
+    """
+    Fast alternative to `chess.pgn.read_game` for training: the games of the pgn file @f are yielded as
+    `MainlineGame`, without building the tree of nodes, comments, variations and annotations.
+
+    :param f: the pgn file, opened in binary mode
+    :param headers: names of the headers to keep (the FEN header is always kept), all of them if None
+    :return: one game at a time
+    """
+    wanted = None if headers is None else set(headers) | {'FEN'}
+    game_headers, movetext = None, []
+    seen_movetext = False
+    for line in f:
+        if line.startswith(b'['):
+            if seen_movetext:
+                yield MainlineGame(game_headers, b''.join(movetext))
+                game_headers, movetext = None, []
+                seen_movetext = False
+            if game_headers is None:
+                game_headers = {}
+            match = _HEADER_RE.match(line)
+            if match:
+                name = match.group(1).decode()
+                if wanted is None or name in wanted:
+                    game_headers[name] = match.group(2).decode(errors='replace')
+        elif line.strip() and not line.startswith(b'%') and game_headers is not None:
+            # the text before the first header (e.g. a comment of the exporter) is not a game, as in `_scan_pgn`
+            seen_movetext = True
+            movetext.append(line)
+    if game_headers is not None:
+        yield MainlineGame(game_headers, b''.join(movetext))
+
+
+def mainline_parser(fname: str = FILENAME, headers: tuple[str, ...] = None) -> MainlineGame:
+    """
+    Same as `file_parser`, but the games are read with `read_mainlines`.
+    """
+    with open(fname, 'rb') as f:
+        yield from read_mainlines(f, headers)
+
+
+def _scan_pgn(fname: str, headers: tuple[str, ...]) -> dict[str, np.ndarray]:
+    # one pass over the lines of the file: a header line that follows some movetext starts a new game
+    offsets, plies = [], []
+    values = {name: [] for name in headers}
+    wanted = {name.encode(): name for name in headers}
+    movetext = []
+    seen_movetext = True
+    with open(fname, 'rb') as f:
+        offset = 0
+        for line in f:
+            if line.startswith(b'['):
+                if seen_movetext:
+                    if offsets:
+                        plies.append(_count_plies(b''.join(movetext)))
+                    offsets.append(offset)
+                    for name in headers:
+                        values[name].append('')
+                    movetext = []
+                    seen_movetext = False
+                match = _HEADER_RE.match(line)
+                if match and match.group(1) in wanted:
+                    values[wanted[match.group(1)]][-1] = match.group(2).decode(errors='replace')
+            elif line.strip() and offsets:
+                seen_movetext = True
+                movetext.append(line)
+            offset += len(line)
+    if offsets:
+        plies.append(_count_plies(b''.join(movetext)))
+
+    offsets = np.array(offsets, dtype=np.int64)
+    index = {'offsets': offsets,
+             'lengths': np.diff(np.append(offsets, offset)),
+             'plies': np.array(plies, dtype=np.int32)}
+    index.update({f'header_{name}': np.array(v, dtype=str) for name, v in values.items()})
+    index.update({f'column_{name}': column for name, column in parse_headers(values).items()})
+    return index
+
+
+def _query_name(node: ast.expr) -> str | None:
+    # the dotted name of a Name or Attribute node (e.g. 'np.char.startswith'), None for any other node
+    if isinstance(node, ast.Name):
+        return node.id
+    if isinstance(node, ast.Attribute):
+        value = _query_name(node.value)
+        return None if value is None else f"{value}.{node.attr}"
+    return None
+
+
+def _eval_query(node: ast.expr, columns: dict[str, np.ndarray]):
+    # evaluate the expression @node of a query: only the columns, constants, QUERY_OPERATORS and QUERY_FUNCTIONS
+    if isinstance(node, ast.Constant) and isinstance(node.value, (bool, int, float, str)):
+        return node.value
+    if isinstance(node, ast.Name):
+        if node.id not in columns:
+            raise ValueError(f"Error: unknown column {node.id} in query, the columns are {sorted(columns)}")
+        return columns[node.id]
+    if isinstance(node, ast.UnaryOp) and type(node.op) in QUERY_OPERATORS:
+        return QUERY_OPERATORS[type(node.op)](_eval_query(node.operand, columns))
+    if isinstance(node, ast.BinOp) and type(node.op) in QUERY_OPERATORS:
+        return QUERY_OPERATORS[type(node.op)](_eval_query(node.left, columns), _eval_query(node.right, columns))
+    if isinstance(node, ast.Compare) and all(type(op) in QUERY_OPERATORS for op in node.ops):
+        # a chained comparison a < b < c is (a < b) & (b < c)
+        operands = [_eval_query(operand, columns) for operand in [node.left, *node.comparators]]
+        masks = [QUERY_OPERATORS[type(op)](a, b) for op, a, b in zip(node.ops, operands, operands[1:])]
+        return functools.reduce(operator.and_, masks)
+    if isinstance(node, ast.Call) and _query_name(node.func) in QUERY_FUNCTIONS and not node.keywords:
+        return QUERY_FUNCTIONS[_query_name(node.func)](*(_eval_query(arg, columns) for arg in node.args))
+    raise ValueError(f"Error: {ast.unparse(node)} is not allowed in a query, use the columns, constants, "
+                     f"comparisons, & | ~ + - * / and the functions {list(QUERY_FUNCTIONS)}")
+
+
+def _parse_int(values: list[str]) -> np.ndarray:
+    return np.array([int(v) if v.isdigit() else -1 for v in values], dtype=np.int32)
+
+
+def parse_headers(values: dict[str, list[str]]) -> dict[str, np.ndarray]:
+    """
+    Parse the header strings of the games into typed columns, to be queried with `PgnIndex.select`:
+    WhiteElo and BlackElo as integers, Result as the score of white (1, 0.5, 0 or NaN if unknown), TimeControl
+    split in BaseTime and Increment seconds. Missing or unknown numbers are -1, the other headers are kept as strings.
+
+    :param values: the header values of each game, by header name
+    :return: the columns, by name
+    """
+    columns = {}
+    for name, v in values.items():
+        if name in ('WhiteElo', 'BlackElo'):
+            columns[name] = _parse_int(v)
+        elif name == 'Result':
+            columns[name] = np.array([RESULT_SCORES.get(r, np.nan) for r in v], dtype=np.float32)
+        elif name == 'TimeControl':
+            columns[name] = np.array(v, dtype=str)
+            base, increment = zip(*((t.partition('+')[0], t.partition('+')[2] or '0') for t in v)) if v else ((), ())
+            columns['BaseTime'] = _parse_int(base)
+            columns['Increment'] = np.where(columns['BaseTime'] < 0, -1, _parse_int(increment))
+        else:
+            columns[name] = np.array(v, dtype=str)
+    return columns
+
+
+class PgnIndex:
+
+    def __init__(self, fname=FILENAME, headers=INDEX_HEADERS, rebuild=False):
+        """
+        Index of the games of a pgn file: byte offset, length, number of plies and some headers of each game.
+        It is built with a single scan of the file, without parsing the games, and stored in the sidecar file
+        `<fname>.index.npz`, which is rebuilt when the pgn file or the requested headers change.
+        The games can then be read directly with `get_game` and `iter_games`, and selected by their headers with
+        `select`.
+        :param fname: File path to pgn file
+        :param headers: names of the headers to be stored in the index
+        :param rebuild: if True, rebuild the index even if it is up to date
+        """
+        self.fname = fname
+        self.index_fname = f"{fname}.index.npz"
+        stat = os.stat(fname)
+        source = np.array([stat.st_size, stat.st_mtime_ns, INDEX_VERSION], dtype=np.int64)
+        headers = tuple(headers)
+
+        index = None
+        if not rebuild and os.path.isfile(self.index_fname):
+            try:
+                with np.load(self.index_fname) as f:
+                    index = dict(f)
+                if not np.array_equal(index['source'], source) or tuple(index['headers']) != headers:
+                    index = None
+            except (OSError, ValueError, KeyError, EOFError, zipfile.BadZipFile) as e:
+                # e.g. a file truncated by a crash, it is rebuilt
+                logging.warning(f"Error: unreadable index {self.index_fname}, rebuilding it: {e}")
+                index = None
+        if index is None:
+            index = _scan_pgn(fname, headers)
+            index['source'] = source
+            index['headers'] = np.array(headers, dtype=str)
+            # written to a temporary file and renamed, so that the processes reading the index concurrently (e.g. the
+            # ranks of a distributed job) never see a partial file
+            fd, tmp = tempfile.mkstemp(prefix='.index-', suffix='.npz', dir=os.path.dirname(self.index_fname) or '.')
+            try:
+                with os.fdopen(fd, 'wb') as f:
+                    np.savez(f, **index)
+                os.replace(tmp, self.index_fname)
+            finally:
+                if os.path.exists(tmp):
+                    os.remove(tmp)
+
+        self.offsets = index['offsets']
+        self.lengths = index['lengths']
+        self.plies = index['plies']
+        self.headers = {name: index[f'header_{name}'] for name in headers}
+        # the parsed headers (see `parse_headers`) and the number of plies of each game
+        self.columns = {name[len('column_'):]: column for name, column in index.items() if name.startswith('column_')}
+        self.columns['Plies'] = self.plies
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def _read(self, f, i: int) -> chess.pgn.Game:
+        f.seek(self.offsets[i])
+        return chess.pgn.read_game(io.StringIO(f.read(self.lengths[i]).decode()))
+
+    def get_game(self, i: int) -> chess.pgn.Game:
+        """
+        Read the game @i of the file, seeking directly to it.
+        """
+        with open(self.fname, 'rb') as f:
+            return self._read(f, i)
+
+    def iter_games(self, indices=None) -> chess.pgn.Game:
+        """
+        Yield the games @indices of the file (all of them if None), in the given order.
+        """
+        indices = range(len(self)) if indices is None else indices
+        with open(self.fname, 'rb') as f:
+            for i in indices:
+                yield self._read(f, i)
+
+    def ranges(self, indices, chunk_size: int = CHUNK_SIZE) -> list[tuple[int, int]]:
+        """
+        Byte ranges of the file holding the games @indices, in file order as `split_pgn`: consecutive games are
+        merged in ranges of about @chunk_size bytes, so that the games can be parsed without reading the others.
+        """
+        ranges = []
+        for i in np.sort(np.asarray(indices, dtype=np.int64)).tolist():
+            start, end = int(self.offsets[i]), int(self.offsets[i] + self.lengths[i])
+            if ranges and ranges[-1][1] == start and end - ranges[-1][0] <= chunk_size:
+                ranges[-1] = (ranges[-1][0], end)
+            else:
+                ranges.append((start, end))
+        return ranges
+
+    def select(self, query) -> np.ndarray:
+        """
+        Indices of the games that satisfy @query, evaluated on the `columns` of the index without reading the games.
+        :param query: an expression of the columns, e.g.
+        "(WhiteElo >= 2000) & (BlackElo >= 2000) & (BaseTime >= 600) & np.char.startswith(ECO, 'B')", made of
+        comparisons combined with & | ~, arithmetic and the QUERY_FUNCTIONS (it is parsed, not evaluated by python),
+        or a function that maps the dict of columns to a boolean mask
+        :return: the sorted indices of the selected games
+        """
+        if callable(query):
+            mask = query(self.columns)
+        else:
+            try:
+                tree = ast.parse(query, mode='eval')
+            except SyntaxError as e:
+                raise ValueError(f"Error: invalid query {query!r}: {e}") from e
+            mask = _eval_query(tree.body, self.columns)
+        mask = np.broadcast_to(np.asarray(mask), (len(self),))
+        if mask.dtype != bool:
+            raise TypeError("Error: argument query must evaluate to a boolean mask of the games")
+        return np.flatnonzero(mask)
 
 
 def game_states(game: chess.pgn.Game) -> tuple[tuple[str, str], str]:
@@ -53,63 +509,812 @@ def game_states(game: chess.pgn.Game) -> tuple[tuple[str, str], str]:
         # save copy before executing move
         old_board = board.copy(stack=False)
         board.push(move)
-        # yield the result one at a time
-        yield (old_board, board), move.uci()
+        # yield the result one at a time, with a copy of the board so that s_t+1 is not changed by the next moves
+        yield (old_board, board.copy(stack=False)), move.uci()
+
+
+def game_states_list(game: chess.pgn.Game) -> list[tuple[tuple[chess.Board, chess.Board], str]]:
+    """
+    All the states of @game, as yielded by `game_states`.
+    """
+    return list(game_states(game))
+
+
+def encoded_game_states(game: chess.pgn.Game, board_transform: str = 'tensor',
+                        dtype=int) -> tuple[tuple[np.ndarray, np.ndarray], str]:
+    """
+    Same as `game_states`, but the states are yielded already encoded: the whole game is encoded incrementally
+    with `encode_game`, instead of encoding each board on its own.
+
+    :param game: the game taken from the database (class chess.pgn.Game)
+    :type game: chess.pgn.Game
+    :param board_transform: representation of the board ['array', 'matrix', 'tensor', 'packed']
+    :param dtype: integer type of the encoding
+    :return: the tuple (s_t, s_t+1) and the ground truth (the move that led from s_t to s_t+1)
+    :rtype: tuple
+    """
+    moves = list(game.mainline_moves())
+    states = encode_game(moves, game.board(), mode=board_transform, dtype=dtype)
+    for i, move in enumerate(moves):
+        yield (states[i], states[i + 1]), move.uci()
+
+
+def encode_game_record(game: chess.pgn.Game) -> tuple[np.ndarray, np.ndarray]:
+    """
+    The positions of @game in 'packed' mode, built incrementally, and the action index of each of its moves.
+
+    :param game: the game taken from the database (class chess.pgn.Game)
+    :return: the (N + 1, PACKED_SIZE) positions and the (N,) actions of a game of N moves
+    """
+    moves = list(game.mainline_moves())
+    positions = encode_game(moves, game.board(), mode='packed')
+    actions = np.fromiter((move_to_index(move) for move in moves), dtype=np.int16, count=len(moves))
+    return positions, actions
+
+
+def encode_move_codes(moves: list[chess.Move]) -> np.ndarray:
+    """
+    Encode each move in 16 bits: from square, to square and promotion piece type in bits 0-5, 6-11 and 12-14.
+    Unlike the action index, the code keeps underpromotions, so that the game can be replayed exactly.
+    """
+    return np.fromiter((move.from_square | move.to_square << 6 | (move.promotion or 0) << 12 for move in moves),
+                       dtype=np.uint16, count=len(moves))
+
+
+def decode_move_codes(codes: np.ndarray) -> list[chess.Move]:
+    """
+    Moves encoded with `encode_move_codes`.
+    """
+    return [chess.Move(code & 63, code >> 6 & 63, code >> 12 or None) for code in codes.tolist()]
+
+
+def encode_game_moves(game: chess.pgn.Game, keyframe_plies: int = KEYFRAME_PLIES) -> tuple[np.ndarray, np.ndarray]:
+    """
+    The move codes of @game (see `encode_move_codes`) and its positions in 'packed' mode every @keyframe_plies plies.
+    """
+    moves = list(game.mainline_moves())
+    keyframes = encode_game(moves, game.board(), mode='packed')[::keyframe_plies]
+    return encode_move_codes(moves), keyframes
+
+
+class GameStore:
+
+    def __init__(self, moves: np.ndarray, game_offsets: np.ndarray, keyframes: np.ndarray,
+                 keyframe_offsets: np.ndarray, keyframe_plies: int = KEYFRAME_PLIES):
+        """
+        Compact store of a set of games: the moves of all the games are kept in a single flat array of 16 bit codes
+        (see `encode_move_codes`), along with a position every @keyframe_plies plies. A position is rebuilt on demand
+        by replaying the moves from the previous keyframe, so a ply takes about 2 + PACKED_SIZE / @keyframe_plies
+        bytes instead of the PACKED_SIZE bytes of a stored position.
+        :param moves: the move codes of all the games, one after the other
+        :param game_offsets: index in @moves of the first move of each game, plus the total number of moves
+        :param keyframes: the keyframes of all the games in 'packed' mode, one after the other
+        :param keyframe_offsets: index in @keyframes of the first keyframe of each game, plus the number of keyframes
+        :param keyframe_plies: plies between two keyframes
+        """
+        self.moves = moves
+        self.game_offsets = game_offsets
+        self.keyframes = keyframes
+        self.keyframe_offsets = keyframe_offsets
+        self.keyframe_plies = keyframe_plies
+
+    @classmethod
+    def from_records(cls, records, keyframe_plies: int = KEYFRAME_PLIES) -> 'GameStore':
+        """
+        Store built from the (move codes, keyframes) of each game, as returned by `encode_game_moves`.
+        """
+        moves, keyframes = [], []
+        for codes, frames in records:
+            moves.append(codes)
+            keyframes.append(frames)
+        return cls(np.concatenate(moves) if moves else np.empty(0, np.uint16),
+                   np.cumsum([0] + [len(m) for m in moves], dtype=np.int64),
+                   np.concatenate(keyframes) if keyframes else np.empty((0, PACKED_SIZE), np.uint8),
+                   np.cumsum([0] + [len(k) for k in keyframes], dtype=np.int64),
+                   keyframe_plies)
+
+    def save(self, out_dir: str):
+        os.makedirs(out_dir, exist_ok=True)
+        for name in ('moves', 'game_offsets', 'keyframes', 'keyframe_offsets'):
+            np.save(os.path.join(out_dir, f"{name}.npy"), getattr(self, name))
+
+    @classmethod
+    def load(cls, out_dir: str, keyframe_plies: int = KEYFRAME_PLIES, mmap_mode: str = 'r') -> 'GameStore':
+        return cls(*(np.load(os.path.join(out_dir, f"{name}.npy"), mmap_mode=mmap_mode)
+                     for name in ('moves', 'game_offsets', 'keyframes', 'keyframe_offsets')), keyframe_plies)
+
+    def __len__(self):
+        # number of moves, i.e. of samples (s_t, s_t+1)
+        return int(self.game_offsets[-1])
+
+    @property
+    def n_games(self) -> int:
+        return len(self.game_offsets) - 1
+
+    def game_moves(self, g: int) -> list[chess.Move]:
+        return decode_move_codes(self.moves[self.game_offsets[g]:self.game_offsets[g + 1]])
+
+    def positions(self, g: int, start: int, stop: int) -> np.ndarray:
+        """
+        The positions from ply @start to ply @stop (excluded) of game @g in 'packed' mode.
+        """
+        k = start // self.keyframe_plies
+        keyframe = self.keyframes[self.keyframe_offsets[g] + k]
+        first = self.game_offsets[g] + k * self.keyframe_plies
+        moves = decode_move_codes(self.moves[first:self.game_offsets[g] + stop - 1])
+        board = decode_batch(keyframe[np.newaxis], trusted=True)[0]
+        return encode_game(moves, board, mode='packed')[start - k * self.keyframe_plies:]
+
+    def sample(self, index: int) -> tuple[np.ndarray, int]:
+        """
+        The packed positions (s_t, s_t+1) of the sample @index and the action index of its move.
+        """
+        g = int(np.searchsorted(self.game_offsets, index, side='right')) - 1
+        ply = index - int(self.game_offsets[g])
+        code = int(self.moves[index])
+        action = int(MOVE_TO_INDEX[code & 63, code >> 6 & 63, code >> 12])
+        return self.positions(g, ply, ply + 2), action
+
+
+def game_hashes(game: chess.pgn.Game) -> np.ndarray:
+    """
+    The polyglot zobrist hash of the position before each move of @game.
+    """
+    board = game.board()
+    hashes = []
+    for move in game.mainline_moves():
+        hashes.append(chess.polyglot.zobrist_hash(board))
+        board.push(move)
+    return np.array(hashes, dtype=np.uint64)
+
+
+def encode_hashed_game_record(game: chess.pgn.Game) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Same as `encode_game_record`, with the `game_hashes` of the game.
+    """
+    return *encode_game_record(game), game_hashes(game)
+
+
+def _write_shard(out_dir: str, k: int, records: list[tuple[np.ndarray, np.ndarray]],
+                 keep: list[np.ndarray] = None) -> dict:
+    positions = np.concatenate([p for p, _ in records]) if records else np.empty((0, PACKED_SIZE), np.uint8)
+    actions = np.concatenate([a for _, a in records]) if records else np.empty(0, np.int16)
+    # the state s_t of each sample is the row samples[i] of positions, s_t+1 is the next row
+    starts = np.cumsum([0] + [len(p) for p, _ in records])
+    samples = np.concatenate([np.arange(s, s + len(a)) for s, (_, a) in zip(starts, records)]) \
+        if records else np.empty(0, np.int64)
+    if keep is not None and records:
+        keep = np.concatenate(keep)
+        samples, actions = samples[keep], actions[keep]
+        # only the rows of the kept samples are stored: when both s_t and s_t+1 are kept they stay adjacent
+        rows = np.union1d(samples, samples + 1)
+        positions = positions[rows]
+        samples = np.searchsorted(rows, samples)
+    shard = {'n_samples': len(actions)}
+    for name, arr in (('positions', positions), ('samples', samples), ('actions', actions)):
+        shard[name] = f"{name}_{k}.npy"
+        np.save(os.path.join(out_dir, shard[name]), arr)
+    return shard
+
+
+def build_dataset(fname: str, out_dir: str, max_games: int = -1, ingest_workers: int = 1,
+                  compact: bool = False, dedup: bool = False, games: np.ndarray = None) -> dict:
+    """
+    Build the pre-encoded dataset of the pgn file @fname in the directory @out_dir: the positions of every game are
+    stored in 'packed' mode, along with the action index of each move, in .npy shards of at most SHARD_SAMPLES
+    samples, and the samples of each game are recorded in GAMES. The manifest describing the shards is written last,
+    so a dataset without manifest is incomplete.
+
+    :param fname: File path to pgn file
+    :param out_dir: directory of the dataset
+    :param max_games: Maximum number of games to be loaded, set to -1 to load all games
+    :param ingest_workers: processes used to parse the pgn file
+    :param compact: if True, store the games in a `GameStore` instead of storing every position
+    :param dedup: if True, the samples with the same position (by zobrist hash) and move are stored once, along with
+    the number of times they occur in counts_<k>.npy
+    :param games: indices of the games of the file to encode (e.g. from `PgnIndex.select`), all of them if None.
+    The other games are not read, @max_games counts the encoded games
+    :return: the manifest of the dataset
+    """
+    if compact and dedup:
+        raise ValueError("Error: a compact dataset stores whole games, it cannot be deduplicated")
+    os.makedirs(out_dir, exist_ok=True)
+    game_fn = encode_game_moves if compact else encode_hashed_game_record if dedup else encode_game_record
+    ranges = None if games is None else PgnIndex(fname).ranges(games)
+    if ingest_workers > 1:
+        it = parallel_file_parser(fname, game_fn, n_workers=ingest_workers, fast=True, ranges=ranges)
+    elif ranges is not None:
+        it = itertools.chain.from_iterable(_parse_range((fname, start, end, game_fn, True)) for start, end in ranges)
+    else:
+        it = map(game_fn, mainline_parser(fname, headers=()))
+    # Get only the first max_games, or all of them if max_games = -1
+    it = itertools.islice(it, max_games) if max_games != -1 else it
+
+    if compact:
+        store = GameStore.from_records(tqdm.tqdm(it, "Unraveling games"))
+        store.save(out_dir)
+        manifest = {'version': DATASET_VERSION, 'fname': fname, 'max_games': max_games,
+                    'store': {'n_samples': len(store), 'keyframe_plies': store.keyframe_plies}}
+        with open(os.path.join(out_dir, MANIFEST), 'w') as f:
+            json.dump(manifest, f, indent=2)
+        return manifest
+
+    shards, records, keep, n_samples = [], [], [], 0
+    # index of the sample of each (zobrist hash, action) and number of occurrences of each sample
+    seen, counts = {}, []
+    # number of samples stored for each game
+    game_samples = []
+    for positions, actions, *hashes in tqdm.tqdm(it, "Unraveling games"):
+        if dedup:
+            new = np.zeros(len(actions), dtype=bool)
+            for j, key in enumerate(zip(hashes[0].tolist(), actions.tolist())):
+                i = seen.setdefault(key, len(counts))
+                if i == len(counts):
+                    counts.append(0)
+                    new[j] = True
+                counts[i] += 1
+            keep.append(new)
+        n_new = int(keep[-1].sum()) if dedup else len(actions)
+        if records and n_samples + n_new > SHARD_SAMPLES:
+            shards.append(_write_shard(out_dir, len(shards), records, keep[:-1] if dedup else None))
+            records, keep, n_samples = [], keep[-1:], 0
+        records.append((positions, actions))
+        n_samples += n_new
+        game_samples.append(n_new)
+    if records or not shards:
+        shards.append(_write_shard(out_dir, len(shards), records, keep if dedup else None))
+    if dedup:
+        # the counts are complete only at the end, as a sample can occur again in any later game
+        counts = np.array(counts, dtype=np.uint32)
+        offsets = np.cumsum([0] + [shard['n_samples'] for shard in shards])
+        for k, shard in enumerate(shards):
+            shard['counts'] = f"counts_{k}.npy"
+            np.save(os.path.join(out_dir, shard['counts']), counts[offsets[k]:offsets[k + 1]])
+
+    np.save(os.path.join(out_dir, GAMES), np.cumsum([0] + game_samples, dtype=np.int64))
+
+    manifest = {'version': DATASET_VERSION, 'fname': fname, 'max_games': max_games, 'shards': shards}
+    with open(os.path.join(out_dir, MANIFEST), 'w') as f:
+        json.dump(manifest, f, indent=2)
+    return manifest
+
+
+def load_manifest(out_dir: str) -> dict | None:
+    """
+    The manifest of the pre-encoded dataset in @out_dir, None if the dataset is missing, incomplete or outdated.
+    """
+    try:
+        with open(os.path.join(out_dir, MANIFEST)) as f:
+            manifest = json.load(f)
+    except FileNotFoundError:
+        return None
+    return manifest if manifest.get('version') == DATASET_VERSION else None
+
+
+class DatasetCache:
+
+    def __init__(self, cache_dir=CACHE_DIR, max_bytes=CACHE_SIZE):
+        """
+        On-disk cache of the datasets built by `build_dataset`. Each dataset is stored in its own directory, named
+        after a key computed from the content of the pgn file, the build parameters and DATASET_VERSION, so that
+        different variants coexist and a changed source is never served from stale data.
+        Datasets are built in a temporary directory and then renamed, so that concurrent jobs never read a
+        half-written dataset. When the cache grows beyond @max_bytes, the least recently used datasets are removed,
+        except the ones held with `lock` by a reader.
+        :param cache_dir: directory of the cache
+        :param max_bytes: size budget of the cache in bytes
+        """
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def _content_hash(self, fname: str) -> str:
+        # hashing a big pgn file is slow: the hash is remembered as long as size and mtime of the file do not change
+        stat = os.stat(fname)
+        source = f"{os.path.realpath(fname)}:{stat.st_size}:{stat.st_mtime_ns}"
+        hashes_fname = os.path.join(self.cache_dir, "hashes.json")
+        try:
+            with open(hashes_fname) as f:
+                hashes = json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            hashes = {}
+        if source not in hashes:
+            h = hashlib.blake2b()
+            with open(fname, 'rb') as f:
+                for block in iter(lambda: f.read(2 ** 20), b''):
+                    h.update(block)
+            hashes[source] = h.hexdigest()
+            tmp = f"{hashes_fname}.{os.getpid()}"
+            with open(tmp, 'w') as f:
+                json.dump(hashes, f)
+            os.replace(tmp, hashes_fname)
+        return hashes[source]
+
+    def key(self, fname: str, params: dict) -> str:
+        """
+        Key of the dataset built from @fname with the build parameters @params.
+        """
+        description = json.dumps({'source': self._content_hash(fname), 'params': params, 'version': DATASET_VERSION},
+                                 sort_keys=True)
+        return hashlib.blake2b(description.encode(), digest_size=16).hexdigest()
+
+    def entries(self) -> list[str]:
+        return [os.path.join(self.cache_dir, name) for name in os.listdir(self.cache_dir)
+                if not name.startswith('.') and os.path.isdir(os.path.join(self.cache_dir, name))]
+
+    def get(self, fname: str, params: dict, build: callable) -> str:
+        """
+        Directory of the dataset built from @fname with @params, calling @build(directory) if it is not cached.
+        """
+        path = os.path.join(self.cache_dir, self.key(fname, params))
+        if load_manifest(path) is None:
+            tmp = tempfile.mkdtemp(prefix=BUILD_PREFIX, dir=self.cache_dir)
+            # held while building, so that `evict` does not remove a build in progress
+            with open(os.path.join(tmp, LOCK), 'a') as lock:
+                if fcntl is not None:
+                    fcntl.flock(lock, fcntl.LOCK_EX)
+                try:
+                    build(tmp)
+                    os.rename(tmp, path)
+                except OSError:
+                    # another job renamed its copy first
+                    if load_manifest(path) is None:
+                        raise
+                finally:
+                    shutil.rmtree(tmp, ignore_errors=True)
+        # the mtime of the manifest records the last use of the dataset
+        os.utime(os.path.join(path, MANIFEST))
+        self.evict(keep=path)
+        return path
+
+    def lock(self, path: str):
+        """
+        Hold the dataset @path, so that it is not evicted until the returned file is closed (the processes forked
+        while it is open hold it as well).
+        :raise FileNotFoundError: if the dataset has been evicted
+        """
+        f = open(os.path.join(path, LOCK), 'a')
+        if fcntl is not None:
+            fcntl.flock(f, fcntl.LOCK_SH)
+        if load_manifest(path) is None:
+            # removed while waiting for the lock
+            f.close()
+            raise FileNotFoundError(f"Error: dataset {path} has been evicted from the cache")
+        return f
+
+    def _remove(self, path: str) -> bool:
+        # remove the dataset (or build directory) @path unless a reader (or its builder) holds it
+        try:
+            f = open(os.path.join(path, LOCK), 'a')
+        except FileNotFoundError:
+            return True
+        with f:
+            if fcntl is not None:
+                try:
+                    fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except BlockingIOError:
+                    return False
+            # removed while holding the lock, so that `lock` does not return a dataset being removed
+            shutil.rmtree(path, ignore_errors=True)
+        return True
+
+    def evict(self, keep: str = None):
+        """
+        Remove the least recently used datasets, except @keep and the ones in use, until the cache fits in its size
+        budget. The directories left over by the builds that crashed (older than STALE_BUILD) are removed first.
+        """
+        for name in os.listdir(self.cache_dir):
+            path = os.path.join(self.cache_dir, name)
+            try:
+                stale = name.startswith(BUILD_PREFIX) and time.time() - os.stat(path).st_mtime > STALE_BUILD
+            except FileNotFoundError:
+                continue
+            if stale:
+                # unless the build is still running, it holds the lock
+                self._remove(path)
+        entries = []
+        for path in self.entries():
+            try:
+                size = sum(entry.stat().st_size for entry in os.scandir(path))
+                last_used = os.stat(os.path.join(path, MANIFEST)).st_mtime
+            except FileNotFoundError:
+                continue
+            entries.append((last_used, size, path))
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            if path != keep and self._remove(path):
+                total -= size
+
+
+def _decode_sample(pair: np.ndarray, action: int, board_transform, move_transform):
+    # (s_t, s_t+1) and ground truth of a sample, from its 2 packed positions and its action index
+    if board_transform is None:
+        b1, b2 = decode_batch(pair, trusted=True)
+    else:
+        b1, b2 = unpack_batch(pair, mode=board_transform, dtype=SAMPLE_DTYPES[board_transform])
+    if board_transform == 'matrix':
+        b1 = np.expand_dims(b1, axis=0)
+        b2 = np.expand_dims(b2, axis=0)
+
+    m = int(action)
+    if move_transform is not move_to_index:
+        m = index_to_move(m)
+        if move_transform is not None:
+            m = move_transform(m)
+    return (b1, b2), m
+
+
+def _collate_samples(pairs: np.ndarray, actions: np.ndarray, board_transform, move_transform):
+    # same as the default collate of the samples returned by `_decode_sample`, but decoding the whole batch at once
+    n = len(actions)
+    if board_transform is None:
+        boards = decode_batch(pairs.reshape(2 * n, PACKED_SIZE), trusted=True)
+        b1, b2 = boards[0::2], boards[1::2]
+    else:
+        boards = unpack_batch(pairs.reshape(2 * n, PACKED_SIZE), mode=board_transform,
+                              dtype=SAMPLE_DTYPES[board_transform])
+        boards = boards.reshape(n, 2, *boards.shape[1:])
+        if board_transform == 'matrix':
+            boards = np.expand_dims(boards, axis=2)
+        b1, b2 = (torch.from_numpy(np.ascontiguousarray(boards[:, j])) for j in range(2))
+
+    actions = actions.astype(np.int64)
+    if move_transform is move_to_index:
+        m = torch.from_numpy(actions)
+    elif move_transform is encode_move:
+        m = torch.zeros((n, ACTION_SPACE_SIZE), dtype=torch.int64)
+        m[torch.arange(n), torch.from_numpy(actions)] = 1
+    else:
+        m = tuple(index_to_move(a) for a in actions.tolist())
+        if move_transform is not None:
+            m = data.default_collate([move_transform(uci) for uci in m])
+    return (b1, b2), m
+
+
+def _move_transform(move_transform):
+    # the function of a move transform given by name (see MOVE_TRANSFORMS)
+    if isinstance(move_transform, str):
+        if move_transform not in MOVE_TRANSFORMS:
+            raise ValueError(f"Error: argument move_transform must be a function or one of {list(MOVE_TRANSFORMS)}")
+        move_transform = MOVE_TRANSFORMS[move_transform]
+    return move_transform
+
+
+class SampleBatch(collections.abc.Sequence):
+
+    def __init__(self, pairs: np.ndarray, actions: np.ndarray, board_transform, move_transform):
+        """
+        Samples of a batch returned by `MoveDataset.__getitems__`, kept packed: each sample is decoded only if it is
+        accessed (e.g. by the default collate of the DataLoader), `collate_batch` decodes the whole batch at once.
+        :param pairs: packed (s_t, s_t+1) of the samples, with shape (N, 2, PACKED_SIZE)
+        :param actions: action indices of the samples
+        """
+        self.pairs = pairs
+        self.actions = actions
+        self.board_transform = board_transform
+        self.move_transform = move_transform
+
+    def __len__(self):
+        return len(self.actions)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+        return _decode_sample(self.pairs[i], self.actions[i], self.board_transform, self.move_transform)
+
+
+def collate_batch(batch):
+    """
+    Collate function of the DataLoaders of `MoveDataset`: the samples of a `SampleBatch` are decoded in a single
+    vectorized call into contiguous tensors, any other batch is collated by the default collate of torch.
+    """
+    if isinstance(batch, SampleBatch):
+        return _collate_samples(batch.pairs, batch.actions, batch.board_transform, batch.move_transform)
+    return data.default_collate(batch)
 
 
 class MoveDataset(data.Dataset):
 
-    def __init__(self, fname=FILENAME, max_games=-1, board_transform='array', move_transform=None):
+    def __init__(self, fname=FILENAME, max_games=-1, board_transform='array', move_transform=None, ingest_workers=1,
+                 cache_dir=CACHE_DIR, cache_size=CACHE_SIZE, compact=False, dedup=False, mirror=0.0, query=None):
         """
-        Move Dataset built from pgn file
+        Move Dataset built from pgn file. The games are encoded once into .npy shards (see `build_dataset`), kept in
+        a `DatasetCache`, which are then memory mapped: loading is immediate and the DataLoader workers share the
+        same pages.
         :param fname: File path to pgn file
         :param max_games: Maximum number of games to be loaded, set to -1 to load all games
-        :param board_transform: representation of the board ['array', 'matrix', 'tensor']
-        :param move_transform: function for transforming move ground truth
+        :param board_transform: representation of the board ['array', 'matrix', 'tensor'], boards are returned if None
+        :param move_transform: function for transforming move ground truth, or one of ['index', 'one_hot']
+        :param ingest_workers: processes used to parse the pgn file when the dataset is built
+        :param cache_dir: directory of the cache of the pre-encoded datasets
+        :param cache_size: size budget of the cache in bytes
+        :param compact: if True, keep the games in a `GameStore` and replay the positions when they are read
+        :param dedup: if True, merge the samples with the same position and move, see `weights`
+        :param mirror: probability of mirroring each sample (see `boardarray.mirror_batch`), to augment the data
+        :param query: if not None, build the dataset only from the games selected by `PgnIndex.select` with @query
+        among the first @max_games games of the file, the other games are not read
         """
         super().__init__()
         self.fname = fname
         self.max_games = max_games
         self.board_transform = board_transform
-        self.move_transform = move_transform
+        self.move_transform = _move_transform(move_transform)
+        self.mirror = mirror
+        self.query = query
 
         print("Loading dataset...")
-        file_path = f"{PROJECT_PATH}/data/dataset100.pickle"
-        if os.path.isfile(file_path):
-            with open(file_path, 'rb') as f:
-                t = datetime.datetime.now()
-                self.states = pickle.load(f)
-                t = datetime.datetime.now() - t
-                print(f"Loading finished in {t.seconds} seconds")
+        t = datetime.datetime.now()
+        # board and move transforms are applied when the samples are read, they do not change the stored dataset
+        cache = DatasetCache(cache_dir, cache_size)
+        params = {'max_games': max_games}
+        if compact:
+            params['compact'] = True
+        if dedup:
+            params['dedup'] = True
+        games = None
+        if query is not None:
+            games = PgnIndex(fname).select(query)
+            if max_games != -1:
+                games = games[games < max_games]
+            # the key depends on the selected games rather than on the query, which can be a function
+            params['games'] = hashlib.blake2b(games.tobytes(), digest_size=16).hexdigest()
+        while True:
+            self.dataset_dir = cache.get(fname, params, lambda out_dir: build_dataset(
+                fname, out_dir, -1 if games is not None else max_games, ingest_workers, compact, dedup, games))
+            try:
+                # the shards are opened lazily by the DataLoader workers: the dataset is held until it is deleted
+                self._lock = cache.lock(self.dataset_dir)
+                break
+            except FileNotFoundError:
+                # evicted by another job in the meantime, it is built again
+                continue
+        self.manifest = load_manifest(self.dataset_dir)
+        if 'store' in self.manifest:
+            self.shard_offsets = np.array([0, self.manifest['store']['n_samples']])
         else:
-            # Get only the first max_games, or all of them if max_games = -1
-            it = itertools.islice(file_parser(self.fname), max_games) if max_games != -1 else file_parser(self.fname)
-            games = [game for game in tqdm.tqdm(it, "Unraveling games")]
-            self.states = list(itertools.chain(*(list(game_states(g)) for g in games)))
-            with open(file_path, 'wb') as f:
-                pickle.dump(self.states, f, protocol=pickle.HIGHEST_PROTOCOL)
+            # index of the first sample of each shard
+            self.shard_offsets = np.cumsum([0] + [shard['n_samples'] for shard in self.manifest['shards']])
+        self._shards = None
+        self._store = None
+        t = datetime.datetime.now() - t
+        print(f"Loading finished in {t.seconds} seconds")
+
+    @property
+    def shards(self) -> list[tuple[np.ndarray, np.ndarray, np.ndarray]]:
+        # opened lazily, so that each DataLoader worker maps the files on its own instead of receiving copies
+        if self._shards is None:
+            self._shards = [tuple(np.load(os.path.join(self.dataset_dir, shard[name]), mmap_mode='r')
+                                  for name in ('positions', 'samples', 'actions'))
+                            for shard in self.manifest['shards']]
+        return self._shards
+
+    @property
+    def store(self) -> GameStore | None:
+        # the `GameStore` of a compact dataset, None otherwise
+        if self._store is None and 'store' in self.manifest:
+            self._store = GameStore.load(self.dataset_dir, self.manifest['store']['keyframe_plies'])
+        return self._store
+
+    @property
+    def weights(self) -> np.ndarray:
+        """
+        Sampling weight of each sample: the number of times its position and move occur in the games of a
+        deduplicated dataset, 1 otherwise.
+        """
+        if 'store' in self.manifest or 'counts' not in self.manifest['shards'][0]:
+            return np.ones(len(self))
+        return np.concatenate([np.load(os.path.join(self.dataset_dir, shard['counts']))
+                               for shard in self.manifest['shards']]).astype(np.float64)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_shards'] = None
+        state['_store'] = None
+        # the workers started with spawn do not hold the lock, the main process does
+        state['_lock'] = None
+        return state
 
     def __len__(self):
-        return len(self.states)
+        return int(self.shard_offsets[-1])
+
+    def _gather(self, indices: list[int]) -> tuple[np.ndarray, np.ndarray]:
+        # the packed (s_t, s_t+1) of the samples @indices, with shape (N, 2, PACKED_SIZE), and their action indices
+        indices = np.asarray(indices, dtype=np.int64)
+        indices = np.where(indices < 0, indices + len(self), indices)
+        if self.store is not None:
+            pairs, actions = zip(*(self.store.sample(i) for i in indices.tolist()))
+            pairs, actions = np.stack(pairs), np.array(actions, dtype=np.int64)
+        else:
+            pairs = np.empty((len(indices), 2, PACKED_SIZE), dtype=np.uint8)
+            actions = np.empty(len(indices), dtype=np.int64)
+            shard_ids = np.searchsorted(self.shard_offsets, indices, side='right') - 1
+            for k in np.unique(shard_ids).tolist():
+                positions, samples, shard_actions = self.shards[k]
+                selected = shard_ids == k
+                i = indices[selected] - self.shard_offsets[k]
+                p = samples[i]
+                pairs[selected, 0] = positions[p]
+                pairs[selected, 1] = positions[p + 1]
+                actions[selected] = shard_actions[i]
+        if self.mirror:
+            # torch draws a different seed in each DataLoader worker, numpy would repeat the same draws
+            flipped = (torch.rand(len(actions)) < self.mirror).numpy()
+            pairs[flipped] = mirror_batch(pairs[flipped], 'packed')
+            actions[flipped] = MIRROR_INDEX[actions[flipped]]
+        return pairs, actions
 
     def __getitem__(self, index):
-        (b1, b2), m = self.states[index]
-        if self.board_transform == 'array':
-            b1, b2 = BoardArray.to_low_level(b1), BoardArray.to_low_level(b1)
-        if self.board_transform == 'matrix':
-            b1, b2 = BoardArray.to_low_level(b1, mode='matrix'), BoardArray.to_low_level(b2, mode='matrix')
-            b1 = np.expand_dims(b1, axis=0)
-            b2 = np.expand_dims(b2, axis=0)
-        if self.board_transform == 'tensor':
-            b1, b2 = BoardArray.to_low_level(b1, mode='tensor'), BoardArray.to_low_level(b2, mode='tensor')
-        if self.move_transform is not None:
-            m = self.move_transform(m)
-        return (b1, b2), m
+        pairs, actions = self._gather([index])
+        return _decode_sample(pairs[0], actions[0], self.board_transform, self.move_transform)
+
+    def __getitems__(self, indices: list[int]):
+        """
+        Fetch a whole batch at once: the samples are gathered with a single read per shard. They are returned as a
+        `SampleBatch`, which `collate_batch` decodes in a single vectorized call (the default collate decodes them
+        one by one).
+        """
+        pairs, actions = self._gather(indices)
+        return SampleBatch(pairs, actions, self.board_transform, self.move_transform)
+
+
+class StreamingMoveDataset(data.IterableDataset):
+
+    def __init__(self, fname=FILENAME, max_games=-1, board_transform='array', move_transform=None,
+                 shuffle_buffer=SHUFFLE_BUFFER, split=(0.0, 1.0), seed=None, query=None, num_replicas=1, rank=0,
+                 split_games=SPLIT_GAMES, mirror=0.0):
+        """
+        Move Dataset streamed from pgn file: the games are parsed and encoded while iterating, so the memory used does
+        not depend on the size of the file. The games are split among the DataLoader workers (of all the processes of
+        a distributed job) by index, each worker shuffles its samples in a buffer of @shuffle_buffer samples.
+        :param fname: File path to pgn file
+        :param max_games: Maximum number of games to be read, set to -1 to read all games
+        :param board_transform: representation of the board ['array', 'matrix', 'tensor'], boards are returned if None
+        :param move_transform: function for transforming move ground truth, or one of ['index', 'one_hot']
+        :param shuffle_buffer: size of the shuffle buffer, set to 0 to yield the samples in order
+        :param split: fraction (start, stop) of each block of @split_games games yielded by the dataset, so that
+        disjoint splits of a file can be streamed without knowing its number of games
+        :param seed: seed of the shuffle, a different shuffle is drawn at each iteration if None
+        :param query: if not None, stream only the games selected by `PgnIndex.select` with @query, the others are
+        skipped without parsing them
+        :param num_replicas: number of processes of the distributed job, each one streams a disjoint part of the games
+        :param rank: rank of this process among the @num_replicas ones
+        :param split_games: size of the blocks of consecutive games divided among the splits, the splits of a file
+        with fewer games (or of less than @max_games) can be empty
+        :param mirror: probability of mirroring each sample (see `boardarray.mirror_batch`), to augment the data
+        """
+        super().__init__()
+        if not 0 <= rank < num_replicas:
+            raise ValueError("Error: argument rank must be in [0, num_replicas)")
+        self.fname = fname
+        self.max_games = max_games
+        self.board_transform = board_transform
+        self.move_transform = _move_transform(move_transform)
+        self.shuffle_buffer = shuffle_buffer
+        self.mirror = mirror
+        if not 0.0 <= split[0] <= split[1] <= 1.0:
+            raise ValueError("Error: argument split must be a pair (start, stop) with 0 <= start <= stop <= 1")
+        self.split = range(round(split[0] * split_games), round(split[1] * split_games))
+        self.split_games = split_games
+        if split[0] < split[1] and (len(self.split) == 0 or max_games != -1 and self.split.start >= max_games):
+            raise ValueError(f"Error: the split {split} of blocks of {split_games} games has no game, use a smaller "
+                             f"split_games")
+        self.seed = seed
+        self.epoch = 0
+        self.num_replicas = num_replicas
+        self.rank = rank
+        # mask of the selected games, None if all of them are
+        self.selected = None
+        if query is not None:
+            index = PgnIndex(fname)
+            self.selected = np.zeros(len(index), dtype=bool)
+            self.selected[index.select(query)] = True
+
+    def set_epoch(self, epoch: int):
+        """
+        Set the epoch of the next iteration, to draw a different (but reproducible) shuffle at each epoch.
+        """
+        self.epoch = epoch
+
+    def games(self) -> MainlineGame:
+        """
+        Yield the games of the file assigned to this DataLoader worker of this process, the others are skipped without
+        parsing their moves (see `MainlineGame`).
+        """
+        worker = data.get_worker_info()
+        worker_id, n_workers = (worker.id, worker.num_workers) if worker is not None else (0, 1)
+        # the workers of all the processes take turns
+        worker_id, n_workers = self.rank * n_workers + worker_id, self.num_replicas * n_workers
+        games = mainline_parser(self.fname, headers=())
+        games = itertools.islice(games, self.max_games) if self.max_games != -1 else games
+        # index of the game among the ones of the split
+        n = 0
+        for i, game in enumerate(games):
+            if self.selected is not None and not (i < len(self.selected) and self.selected[i]):
+                continue
+            if (i % self.split_games) in self.split:
+                if n % n_workers == worker_id:
+                    yield game
+                n += 1
+        if n == 0 and worker_id == 0:
+            # e.g. a file with fewer games than the start of the split in a block of split_games
+            logging.warning(f"Error: no game of {self.fname} is in the split {self.split} of blocks of "
+                            f"{self.split_games} games")
+
+    def samples(self) -> tuple[tuple[np.ndarray, np.ndarray], str]:
+        """
+        Yield the samples of the games of this worker, in the order of the file.
+        """
+        for game in self.games():
+            positions, actions = encode_game_record(game)
+            # (s_t, s_t+1) of each move of the game
+            pairs = np.stack([positions[:-1], positions[1:]], axis=1)
+            actions = actions.astype(np.int64)
+            if self.mirror:
+                flipped = (torch.rand(len(actions)) < self.mirror).numpy()
+                pairs[flipped] = mirror_batch(pairs[flipped], 'packed')
+                actions[flipped] = MIRROR_INDEX[actions[flipped]]
+            for i in range(len(actions)):
+                yield _decode_sample(pairs[i], actions[i], self.board_transform, self.move_transform)
+
+    def __iter__(self):
+        if self.shuffle_buffer <= 1:
+            yield from self.samples()
+            return
+        worker = data.get_worker_info()
+        worker_id = worker.id if worker is not None else 0
+        rng = random.Random(None if self.seed is None else hash((self.seed, self.epoch, self.rank, worker_id)))
+        buffer = []
+        for sample in self.samples():
+            if len(buffer) < self.shuffle_buffer:
+                buffer.append(sample)
+                continue
+            # yield a random sample of the buffer and put the new one in its place
+            i = rng.randrange(len(buffer))
+            buffer[i], sample = sample, buffer[i]
+            yield sample
+        rng.shuffle(buffer)
+        yield from buffer
+
+
+class DistributedWeightedSampler(data.Sampler):
+
+    def __init__(self, weights, num_replicas: int = None, rank: int = None, seed: int = 0):
+        """
+        Distributed version of `WeightedRandomSampler`: each process draws its share of the samples, with replacement
+        and with probability proportional to @weights, from a generator seeded by @seed, its rank and the epoch.
+        :param weights: weight of each sample of the dataset
+        :param num_replicas: number of processes, the world size of the default process group if None
+        :param rank: rank of this process, the one in the default process group if None
+        :param seed: seed shared by the processes
+        """
+        super().__init__()
+        self.num_replicas = dist.get_world_size() if num_replicas is None else num_replicas
+        self.rank = dist.get_rank() if rank is None else rank
+        self.weights = torch.as_tensor(weights, dtype=torch.double)
+        self.num_samples = -(-len(self.weights) // self.num_replicas)
+        self.seed = seed
+        self.epoch = 0
+
+    def set_epoch(self, epoch: int):
+        self.epoch = epoch
+
+    def __len__(self):
+        return self.num_samples
+
+    def __iter__(self):
+        generator = torch.Generator()
+        generator.manual_seed((self.seed + self.epoch) * self.num_replicas + self.rank)
+        yield from torch.multinomial(self.weights, self.num_samples, replacement=True, generator=generator).tolist()
 
 
 def get_dataloader(fname, max_games=-1, batch_size=32, num_workers=5,
                    board_transform=None, move_transform=None,
-                   split_perc=(0.7, 0.1, 0.2), logger=None):
+                   split_perc=(0.7, 0.1, 0.2), logger=None, ingest_workers=1,
+                   cache_dir=CACHE_DIR, cache_size=CACHE_SIZE, streaming=False, shuffle_buffer=SHUFFLE_BUFFER,
+                   compact=False, dedup=False, mirror=0.0, query=None, distributed=False, pin_memory=False,
+                   prefetch_factor=None, split_games=SPLIT_GAMES):
     """
     Get dataloader for move dataset
     :param logger: the logger object
@@ -118,23 +1323,85 @@ def get_dataloader(fname, max_games=-1, batch_size=32, num_workers=5,
     :param batch_size: batch size
     :param num_workers: workers for the dataloader
     :param board_transform: function for transforming board state
-    :param move_transform: function for transforming move ground truth
+    :param move_transform: function for transforming move ground truth, or one of ['index', 'one_hot']
     :param split_perc: train eval test percentage split, pass a tuple of 3 floats
+    :param ingest_workers: processes used to parse the pgn file when the dataset is built
+    :param cache_dir: directory of the cache of the pre-encoded datasets
+    :param cache_size: size budget of the cache in bytes
+    :param streaming: stream the games from the pgn file with `StreamingMoveDataset` instead of building the dataset,
+    not supported with @compact and @dedup
+    :param shuffle_buffer: size of the shuffle buffer of the training set when streaming
+    :param compact: keep the games in a `GameStore` instead of storing every position (see `MoveDataset`)
+    :param dedup: merge the samples with the same position and move, the training samples are then drawn with
+    probability proportional to their number of occurrences
+    :param mirror: probability of mirroring each training sample, see `MoveDataset`
+    :param query: selection of the games by their headers, e.g. "(WhiteElo >= 2000) & (Result == 1)", see
+    `PgnIndex.select`
+    :param distributed: split every set among the processes of the default process group (see
+    `utils.init_distributed`), the training samples are reshuffled at each epoch by `set_epoch` of the sampler
+    :param pin_memory: collate the batches in page-locked memory, so that they can be copied to a gpu asynchronously
+    :param prefetch_factor: batches loaded in advance by each worker, the default of DataLoader if None
+    :param split_games: when streaming, the games are divided among the splits in blocks of @split_games, see
+    `StreamingMoveDataset`
     :return: train_dataloader, val_dataloader, test_dataloader
     """
     assert sum(split_perc) == 1.0
-    dataset = MoveDataset(fname, max_games, board_transform=board_transform, move_transform=move_transform)
+    if streaming and (compact or dedup):
+        raise ValueError("Error: arguments compact and dedup apply to the cached dataset, not with streaming")
+    num_replicas, rank = (dist.get_world_size(), dist.get_rank()) if distributed else (1, 0)
+    # the workers are kept alive across the epochs and the evaluations, except the streaming ones: their copy of the
+    # dataset would not see the epoch set by `StreamingMoveDataset.set_epoch`
+    loader_args = dict(batch_size=batch_size, num_workers=num_workers, pin_memory=pin_memory,
+                       persistent_workers=num_workers > 0 and not streaming,
+                       prefetch_factor=prefetch_factor if num_workers > 0 else None)
+    if streaming:
+        bounds = np.cumsum([0.0, *split_perc])
+        bounds[-1] = 1.0
+        datasets = [StreamingMoveDataset(fname, max_games, board_transform=board_transform,
+                                         move_transform=move_transform, split=(bounds[i], bounds[i + 1]),
+                                         shuffle_buffer=shuffle_buffer if i == 0 else 0, query=query,
+                                         num_replicas=num_replicas, rank=rank, split_games=split_games,
+                                         mirror=mirror if i == 0 else 0.0)
+                    for i in range(3)]
+        return tuple(data.DataLoader(dataset, **loader_args) for dataset in datasets)
+    # the first process of each node builds the dataset, the others find it in the cache
+    first = not distributed or int(os.environ.get('LOCAL_RANK', rank)) == 0
+    if not first:
+        dist.barrier()
+    dataset = MoveDataset(fname, max_games, board_transform=board_transform, move_transform=move_transform,
+                          ingest_workers=ingest_workers, cache_dir=cache_dir, cache_size=cache_size, compact=compact,
+                          dedup=dedup, query=query)
+    if distributed and first:
+        dist.barrier()
     tot_samples = len(dataset)
     t1, t2, t3 = split_perc[0] * tot_samples, (split_perc[0] + split_perc[1]) * tot_samples, tot_samples
     train_idx = range(0, int(t1))
     val_idx = range(int(t1), int(t2))
     test_idx = range(int(t2), int(t3))
-    train_dataset = data.Subset(dataset, indices=train_idx)
+    for name, idx in [('train', train_idx), ('validation', val_idx), ('test', test_idx)]:
+        if len(idx) == 0:
+            logging.warning(f"Error: the {name} split of {fname} has no sample")
+    # the training samples are augmented, the evaluation ones are not
+    train_dataset = copy.copy(dataset)
+    train_dataset.mirror = mirror
+    train_dataset = data.Subset(train_dataset, indices=train_idx)
     val_dataset = data.Subset(dataset, indices=val_idx)
     test_dataset = data.Subset(dataset, indices=test_idx)
-    train_dataloader = data.DataLoader(train_dataset, batch_size=batch_size, num_workers=num_workers, shuffle=True)
-    val_dataloader = data.DataLoader(val_dataset, batch_size=batch_size, num_workers=num_workers, shuffle=False)
-    test_dataloader = data.DataLoader(test_dataset, batch_size=batch_size, num_workers=num_workers, shuffle=False)
+    if dedup and distributed:
+        sampler = DistributedWeightedSampler(dataset.weights[train_idx], num_replicas=num_replicas, rank=rank)
+    elif dedup:
+        sampler = data.WeightedRandomSampler(dataset.weights[train_idx], num_samples=len(train_idx))
+    elif distributed:
+        sampler = data.DistributedSampler(train_dataset, num_replicas=num_replicas, rank=rank, shuffle=True)
+    else:
+        sampler = data.RandomSampler(train_dataset)
+    train_dataloader = data.DataLoader(train_dataset, sampler=sampler, collate_fn=collate_batch, **loader_args)
+    # the evaluation sets are split in order, padded with their first samples to the same length on every process
+    val_dataloader, test_dataloader = (
+        data.DataLoader(subset, collate_fn=collate_batch, **loader_args,
+                        sampler=data.DistributedSampler(subset, num_replicas=num_replicas, rank=rank, shuffle=False)
+                        if distributed else None)
+        for subset in (val_dataset, test_dataset))
     return train_dataloader, val_dataloader, test_dataloader
 
 
@@ -5,7 +5,6 @@ import yaml
 
 import games_from_dataset as gd
 import utils
-from actionspace import encode_move
 
 from experiment_launcher import train, test
 from logs.local_logging import make_logger
@@ -18,21 +17,43 @@ def main():
         config = yaml.safe_load(f)
     # if you want to change some parameters, you can edit dictionary config (ex. config[par1][par1.1]=val)
 
+    distributed = config['setup_args'].get('distributed', False)
+    if distributed:
+        # one process per torchrun worker, only the one of rank 0 logs and saves the checkpoints
+        rank, local_rank, world_size = utils.init_distributed(threads=config['setup_args'].get('threads'))
+        if config['setup_args']['device'].startswith('cuda'):
+            config['setup_args']['device'] = f'cuda:{local_rank}'
+
     utils.set_random_seed(config['exp_args']['seed'])
 
-    logger = make_logger(config['setup_args']['logger'])
+    logger = make_logger(config['setup_args']['logger']) if utils.is_main_process() else None
     # logger.info(f"{str(logger)} is available")
 
     model = AutoEncoder(config)
+    # class indices for the cross entropy loss, one hot vectors for the mse loss
+    move_transform = 'index' if config['exp_args']['loss'] == 'cross_ent' else 'one_hot'
     train_data, val_data, test_data = gd.get_dataloader(fname=config['data_loader']['data_path'],
                                                         batch_size=config['exp_args']['batch_size'],
                                                         num_workers=config['data_loader']['n_workers'],
-                                                        board_transform='matrix', move_transform=encode_move)
+                                                        ingest_workers=config['data_loader']['ingest_workers'],
+                                                        cache_dir=config['data_loader']['cache_dir'] or gd.CACHE_DIR,
+                                                        cache_size=int(config['data_loader']['cache_size_gb'] * 2 ** 30),
+                                                        streaming=config['data_loader']['streaming'],
+                                                        shuffle_buffer=config['data_loader']['shuffle_buffer'],
+                                                        split_games=config['data_loader']['split_games'],
+                                                        compact=config['data_loader']['compact'],
+                                                        dedup=config['data_loader']['dedup'],
+                                                        mirror=config['data_loader']['mirror'],
+                                                        query=config['data_loader']['query'],
+                                                        distributed=distributed,
+                                                        pin_memory=config['setup_args']['device'].startswith('cuda'),
+                                                        prefetch_factor=config['data_loader']['prefetch_factor'],
+                                                        board_transform='matrix', move_transform=move_transform)
 
     wandb_name = config['setup_args']['wandb_name'] \
         if config['setup_args']['wandb_name'] is not None else f'run_{time.now().strftime("%Y-%m-%d_%H-%M-%S")}'
 
-    if config['setup_args']['wandblog'] is True:
+    if config['setup_args']['wandblog'] is True and utils.is_main_process():
         wandb.init(
             project="scacchi-polito-bot-ai",
             config=config,
@@ -40,12 +61,14 @@ def main():
         )
 
     if config['exp_args']['type_exp'] == 'train':
-        train(model, train_data, val_data, config, logger)
-        test(model, test_data, config, logger)
+        # the module prepared (e.g. compiled) by train, so that the test does not compile the model again
+        net = train(model, train_data, val_data, config, logger)
+        test(net, test_data, config, logger)
     elif config['exp_args']['type_exp'] == 'test':
         ckpt = torch.load(config['setup_args']['resume'])
         model.load_state_dict(ckpt['model_state_dict'], strict=True)
         test(model, logger)
+    utils.cleanup_distributed()
 
 
 if __name__ == '__main__':
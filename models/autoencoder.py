@@ -1,4 +1,3 @@
-import numpy as np
 import torch.nn as nn
 
 
@@ -55,7 +54,8 @@ class AutoEncoder(nn.Module):
         z1 = self.encoder(b1)
         z2 = self.encoder(b2)
         z3 = z1 - z2
-        z3 = np.squeeze(z3)
+        # (batch_size, lat_dim), also for a batch of a single sample
+        z3 = z3.reshape(batch_size, -1)
         action_space = self.decoder(z3)
         assert action_space.shape == (batch_size, self.out_dim)
         return action_space
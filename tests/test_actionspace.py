@@ -1,7 +1,12 @@
 import pytest
 
 import logs
-from actionspace import decode_move, encode_move, TO_REDUCED_PROMOTION_MAP, PIECE_PROMOTION_SYMBOLS
+import chess
+import numpy as np
+
+from actionspace import decode_move, encode_move, TO_REDUCED_PROMOTION_MAP, PIECE_PROMOTION_SYMBOLS, \
+    ACTION_SPACE_SIZE, BOARD_MOVES, BOARD_SIZE, index_to_move, move_to_index, legal_moves_mask, \
+    decode_topk, MIRROR_INDEX
 from games_from_dataset import file_parser
 
 
@@ -12,6 +17,37 @@ def games_dataset():
 def test_promotion_exceptions():
     pass
 
+def test_index_tables():
+    for index_move in range(ACTION_SPACE_SIZE):
+        move = index_to_move(index_move, output_in_uci=False)
+        assert index_to_move(index_move) == move.uci()
+        if index_move < BOARD_MOVES and index_move // BOARD_SIZE == index_move % BOARD_SIZE:
+            assert move == chess.Move.null()
+            continue
+        assert move_to_index(move) == index_move
+        assert decode_move(encode_move(move, output_in_numpy=False), output_in_uci=False) == move
+    # underpromotions outside of the reduced action space are treated as queen promotions
+    assert move_to_index('b7a8b') == move_to_index('b7a8q')
+
+def test_mirror_index():
+    assert sorted(MIRROR_INDEX.tolist()) == list(range(ACTION_SPACE_SIZE))
+    for index_move in range(ACTION_SPACE_SIZE):
+        move = index_to_move(index_move, output_in_uci=False)
+        if move:
+            mirrored = chess.Move(chess.square_mirror(move.from_square), chess.square_mirror(move.to_square),
+                                  move.promotion)
+            assert MIRROR_INDEX[index_move] == move_to_index(mirrored)
+
+
+def test_legal_moves_mask():
+    boards = [chess.Board(), chess.Board("r3k2r/1P6/8/3pP3/8/8/8/R3K2R w KQkq d6 0 1"),
+              chess.Board("7k/8/8/8/8/8/8/K6q w - - 0 1")]
+    mask = legal_moves_mask(boards)
+    assert mask.shape == (len(boards), ACTION_SPACE_SIZE)
+    for board, row in zip(boards, mask):
+        expected = {move_to_index(move) for move in board.legal_moves}
+        assert set(row.nonzero()[0].tolist()) == expected
+
 def test_dataset_games_consistency(games_dataset):
     game_count = 0
     for game in games_dataset:
@@ -34,3 +70,17 @@ def test_dataset_games_consistency(games_dataset):
             assert decoded_move == move, f'Dataset move: \n\tfrom_square {move.from_square}\n\t to_square{move.to_square}\nDecoded Move:\n\tfrom_square {decoded_move.from_square}\n\tto_square {decoded_move.to_square}'
         game_count += 1
     logs.info(f'Tests passed for {game_count} games')
+
+def test_decode_topk():
+    boards = [chess.Board(), chess.Board("7k/8/8/8/8/8/1q6/K7 w - - 0 1")]
+    scores = np.random.default_rng(0).random((len(boards), ACTION_SPACE_SIZE))
+    moves, values = decode_topk(scores, k=3)
+    assert values.shape == (len(boards), 3)
+    for row_moves, row_values, row_scores in zip(moves, values, scores):
+        assert row_values.tolist() == sorted(row_scores, reverse=True)[:3]
+        assert [row_scores[move_to_index(m)] for m in row_moves] == row_values.tolist()
+    mask = legal_moves_mask(boards)
+    moves, values = decode_topk(scores, k=2, legal_mask=mask, output_in_uci=False)
+    assert all(move in boards[0].legal_moves for move in moves[0])
+    # the second board has a single legal move
+    assert moves[1][0] == chess.Move.from_uci('a1b2') and values[1][1] == -np.inf
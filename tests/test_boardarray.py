@@ -127,6 +127,107 @@ class TestBoardArray(TestCase):
         self.assertEqual(tensor.tolist(), b2_array.tolist())
         self.assertEqual(info.tolist(), b2_info.tolist())
 
+    def test_board_to_low_level_markers(self):
+        # white pawn just pushed to e4 (ep square e3), only the black queen side rook can still castle
+        b1 = boardarray.BoardArray(fen="r3k2r/8/8/8/4Pp2/8/8/4K3 b q e3 0 1")
+        array = b1.to_low_level(mode='array')
+        self.assertEqual(array[28], boardarray.DICTIONARY['P'] + boardarray.OFFSET_ENPASSANT)
+        self.assertEqual(array[56], boardarray.DICTIONARY['r'] + boardarray.OFFSET_CASTLING)
+        self.assertEqual(array[63], boardarray.DICTIONARY['r'])
+        self.assertEqual(array[64:].tolist(), [0, 0, 1])
+        tensor = b1.to_low_level(mode='tensor')
+        self.assertEqual(tensor[boardarray.CHANNEL_DICTIONARY['p'], 3, 4], 2)
+        self.assertEqual(tensor[boardarray.CHANNEL_DICTIONARY['p'], 3, 5], -1)
+        self.assertEqual(tensor[boardarray.CHANNEL_DICTIONARY['r'], 7, 0], -2)
+        self.assertEqual(tensor[boardarray.CHANNEL_DICTIONARY['r'], 7, 7], -1)
+
+    def test_encode_batch(self):
+        boards = [boardarray.BoardArray(fen=self.FEN1), chess.Board(), chess.Board(self.FEN1).mirror()]
+        for mode in boardarray.LOW_LEVEL_MODES:
+            batch, info = boardarray.encode_batch(boards, mode=mode, additional_info=True)
+            self.assertEqual(batch.shape[0], len(boards))
+            for i, b in enumerate(boards):
+                arr, inf = boardarray.BoardArray.to_low_level(b, mode=mode, additional_info=True)
+                self.assertEqual(arr.tolist(), batch[i].tolist())
+                if inf is not None:
+                    self.assertEqual(inf.tolist(), info[i].tolist())
+
+    def test_decode_batch(self):
+        boards = [chess.Board(self.FEN1), chess.Board(), chess.Board(self.FEN1).mirror()]
+        fens = [b.fen() for b in boards]
+        for mode in boardarray.LOW_LEVEL_MODES:
+            batch, info = boardarray.encode_batch(boards, mode=mode, additional_info=True)
+            self.assertEqual(fens, boardarray.decode_batch(batch, info, output_in_fen=True))
+            self.assertEqual(fens, boardarray.decode_batch(batch, info, output_in_fen=True, trusted=True))
+            self.assertEqual(boards, boardarray.decode_batch(batch, info))
+            # empty batch
+            empty = boardarray.encode_batch([], mode=mode)
+            self.assertEqual([], boardarray.decode_batch(empty))
+            self.assertEqual([], boardarray.decode_batch(empty, trusted=True))
+
+    def test_decode_batch_validation(self):
+        with self.assertRaises(RuntimeError):
+            boardarray.decode_batch(np.zeros((2, 9, 8), dtype=int))
+        with self.assertRaises(TypeError):
+            boardarray.decode_batch(np.zeros((2, 8, 8), dtype=float))
+        with self.assertRaises(ValueError):
+            boardarray.decode_batch(np.full((2, 6, 8, 8), 3, dtype=int))
+        with self.assertRaises(RuntimeError):
+            boardarray.decode_batch(np.zeros((2, 8, 8), dtype=int), np.zeros((3, 3), dtype=int))
+
+    def test_compact_dtypes(self):
+        boards = [chess.Board(self.FEN1), chess.Board(), chess.Board(self.FEN1).mirror()]
+        packed = boardarray.encode_batch(boards, mode='packed')
+        self.assertEqual(packed.dtype, np.uint8)
+        self.assertEqual(packed.shape, (len(boards), boardarray.PACKED_SIZE))
+        for mode in ['array', 'matrix', 'tensor']:
+            expected = boardarray.encode_batch(boards, mode=mode)
+            compact = boardarray.encode_batch(boards, mode=mode, dtype=np.int8)
+            self.assertEqual(compact.dtype, np.int8)
+            self.assertEqual(expected.tolist(), compact.tolist())
+            self.assertEqual(expected.tolist(), boardarray.unpack_batch(packed, mode=mode).tolist())
+            b = boardarray.BoardArray(low_level=(compact[0], None if mode == 'array' else np.array(self.INFO1)))
+            self.assertEqual(boards[0], b)
+        self.assertEqual(boards[0], boardarray.BoardArray(low_level=(packed[0], None)))
+        with self.assertRaises(ValueError):
+            boardarray.encode_batch(boards, mode='tensor', dtype=np.uint8)
+
+    def test_encode_game(self):
+        # en passant, castling on both sides, promotion with capture and a double pawn push
+        board = chess.Board("r3k2r/pP4pp/8/3pP3/8/8/P5PP/R3K2R w KQkq d6 0 1")
+        moves = [chess.Move.from_uci(m) for m in ["e5d6", "e8g8", "b7a8q", "h7h5", "e1c1", "f8a8"]]
+        boards = [board.copy()]
+        for move in moves:
+            board.push(move)
+            boards.append(board.copy())
+        for mode in boardarray.LOW_LEVEL_MODES:
+            states, info = boardarray.encode_game(moves, boards[0], mode=mode, additional_info=True)
+            expected, expected_info = boardarray.encode_batch(boards, mode=mode, additional_info=True)
+            self.assertEqual(expected.tolist(), states.tolist())
+            if expected_info is not None:
+                self.assertEqual(expected_info.tolist(), info.tolist())
+
+    def test_mirror_batch(self):
+        board = chess.Board("r3k2r/pP4pp/8/3pP3/8/8/P5PP/R3K2R w KQkq d6 0 1")
+        moves = [chess.Move.from_uci(m) for m in ["e5d6", "e8g8", "b7a8q", "h7h5", "e1c1", "f8a8"]]
+        boards = [board.copy()]
+        for move in moves:
+            board.push(move)
+            boards.append(board.copy())
+        mirrored = [board.mirror() for board in boards]
+        for mode in boardarray.LOW_LEVEL_MODES:
+            for dtype in [int, np.int8]:
+                arr, info = boardarray.encode_batch(boards, mode=mode, additional_info=True, dtype=dtype)
+                expected, expected_info = boardarray.encode_batch(mirrored, mode=mode, additional_info=True,
+                                                                  dtype=dtype)
+                if info is None:
+                    arr = boardarray.mirror_batch(arr, mode)
+                else:
+                    arr, info = boardarray.mirror_batch(arr, mode, info)
+                    self.assertEqual(expected_info.tolist(), info.tolist())
+                self.assertEqual(expected.tolist(), arr.tolist())
+                self.assertEqual(expected.dtype, arr.dtype)
+
     # ------------------------------------------- COMPLETE TEST --------------------------------------------------------
 
     def test_array(self):
@@ -0,0 +1,101 @@
+import threading
+import time
+
+import pytest
+import torch
+
+from experiment_launcher import PrefetchLoader, MetricsAccumulator
+
+
+class SlowLoader:
+    # iterable of the batches 0, 1, ..., n - 1 (endless if n is None), produced every @delay seconds
+    def __init__(self, n=None, delay=0.0, fail_at=None):
+        self.n = n
+        self.delay = delay
+        self.fail_at = fail_at
+        self.produced = 0
+
+    def __len__(self):
+        return self.n
+
+    def __iter__(self):
+        i = 0
+        while self.n is None or i < self.n:
+            if i == self.fail_at:
+                raise RuntimeError(f"batch {i}")
+            time.sleep(self.delay)
+            self.produced += 1
+            yield torch.tensor(i)
+            i += 1
+
+
+def stage_threads():
+    # the background threads of PrefetchLoader
+    return [thread for thread in threading.enumerate() if thread.name.endswith('(_stage)')]
+
+
+@pytest.mark.parametrize('depth', [0, 1, 3])
+def test_prefetch_loader_order(depth):
+    loader = PrefetchLoader(SlowLoader(10), lambda batch: batch * 2, 'cpu', depth=depth)
+    assert len(loader) == 10
+    # each iteration goes through the whole loader again
+    for _ in range(2):
+        assert [batch.item() for batch in loader] == list(range(0, 20, 2))
+
+
+@pytest.mark.parametrize('depth', [0, 2])
+def test_prefetch_loader_error(depth):
+    loader = PrefetchLoader(SlowLoader(10, fail_at=4), lambda batch: batch, 'cpu', depth=depth)
+    batches = []
+    with pytest.raises(RuntimeError, match="batch 4"):
+        for batch in loader:
+            batches.append(batch.item())
+    assert batches == [0, 1, 2, 3]
+    # an error of the transfer reaches the consumer as well
+    with pytest.raises(ZeroDivisionError):
+        list(PrefetchLoader(SlowLoader(3), lambda batch: 1 // 0, 'cpu', depth=depth))
+
+
+def test_prefetch_loader_break():
+    before = stage_threads()
+    source = SlowLoader(delay=0.001)
+    loader = PrefetchLoader(source, lambda batch: batch, 'cpu', depth=2)
+    batches = iter(loader)
+    assert [next(batches).item() for _ in range(3)] == [0, 1, 2] and len(stage_threads()) == len(before) + 1
+    # closing the iteration (as a break out of a for loop does) stops the background thread
+    batches.close()
+    assert stage_threads() == before
+    produced = source.produced
+    time.sleep(0.05)
+    # the thread staged at most depth batches ahead, plus the one it was blocked on
+    assert source.produced == produced <= 3 + 2 + 1
+
+
+@pytest.mark.parametrize('depth', [0, 2])
+def test_prefetch_loader_wait_time(depth):
+    loader = PrefetchLoader(SlowLoader(5, delay=0.02), lambda batch: batch, 'cpu', depth=depth)
+    assert len(list(loader)) == 5 and loader.wait_time >= 5 * 0.02 * 0.9
+    # the consumer waits less when it is slower than the loader, and the time is reset by each iteration
+    for _ in loader:
+        time.sleep(0.04)
+    assert loader.wait_time < 5 * 0.02 * 0.9 if depth else loader.wait_time >= 5 * 0.02 * 0.9
+
+
+def test_metrics_accumulator():
+    metrics = MetricsAccumulator('cpu', sync_every=3)
+    assert metrics.corrects.dtype == torch.int64
+    due = []
+    for step in range(7):
+        predicted = torch.tensor([0, 1, 2, 3])
+        gt = torch.tensor([0, 1, 2, 3]) if step % 2 == 0 else torch.tensor([0, 0, 0, 0])
+        metrics.update(torch.tensor(float(step)), predicted, gt)
+        due.append(metrics.due())
+    # snapshots every sync_every steps
+    assert due == [False, False, True, False, False, True, False]
+    accuracy, avg_loss, tot_loss = metrics.snapshot()
+    # 4 steps with 4 correct predictions and 3 steps with 1, out of 28 samples
+    assert metrics.corrects.item() == 19 and accuracy == pytest.approx(19 / 28 * 100)
+    assert tot_loss == 21.0 and avg_loss == 3.0
+    # a snapshot does not reset the sums
+    metrics.update(torch.tensor(1.0), torch.tensor([5]), torch.tensor([5]))
+    assert metrics.snapshot(reduce=True) == (pytest.approx(20 / 29 * 100), 22.0 / 8, 22.0)
@@ -0,0 +1,366 @@
+import collections
+import fcntl
+import io
+import itertools
+import os.path
+import tempfile
+
+import chess
+import chess.polyglot
+import numpy as np
+import pytest
+import torch.utils.data as data
+
+from actionspace import index_to_move, move_to_index
+from boardarray import BoardArray, encode_game
+from games_from_dataset import file_parser, parallel_file_parser, split_pgn, PgnIndex, MoveDataset, game_states, \
+    DatasetCache, build_dataset, StreamingMoveDataset, GameStore, encode_game_moves, collate_batch, mainline_parser, \
+    read_mainlines, get_dataloader, parse_headers, DistributedWeightedSampler
+
+# small pgn fixture: games of 50 to 110 plies with varied headers, some underpromotions and repeated openings
+DATASET = os.path.join(os.path.dirname(__file__), 'data', 'games.pgn')
+
+
+def game_moves(game):
+    return [move.uci() for move in game.mainline_moves()]
+
+
+def test_split_pgn():
+    ranges = split_pgn(DATASET, chunk_size=4096)
+    assert ranges[0][0] == 0 and ranges[-1][1] == os.path.getsize(DATASET)
+    with open(DATASET, 'rb') as f:
+        for (start, end), (next_start, _) in zip(ranges, ranges[1:]):
+            assert end == next_start
+            f.seek(start)
+            assert f.read(1) == b'['
+
+
+def test_parallel_file_parser():
+    expected = [game_moves(game) for game in file_parser(DATASET)]
+    games = list(parallel_file_parser(DATASET, game_moves, n_workers=2, chunk_size=4096))
+    assert games == expected
+
+
+def test_pgn_index():
+    games = list(file_parser(DATASET))
+    index = PgnIndex(DATASET, rebuild=True)
+    assert len(index) == len(games)
+    for i, game in enumerate(games):
+        assert index.plies[i] == len(game_moves(game))
+        assert index.headers['Result'][i] == game.headers['Result']
+    # loaded from the sidecar file
+    index = PgnIndex(DATASET)
+    indices = [len(games) - 1, 0, len(games) // 2]
+    assert [game_moves(g) for g in index.iter_games(indices)] == [game_moves(games[i]) for i in indices]
+    assert game_moves(index.get_game(1)) == game_moves(games[1])
+    # a truncated sidecar file is rebuilt
+    with open(index.index_fname, 'r+b') as f:
+        f.truncate(100)
+    assert len(PgnIndex(DATASET)) == len(games) and len(PgnIndex(DATASET)) == len(games)
+
+
+def test_parse_headers():
+    columns = parse_headers({'WhiteElo': ['1500', '?', ''], 'Result': ['1-0', '1/2-1/2', '*'],
+                             'TimeControl': ['300+2', '600', '-'], 'ECO': ['B00', 'C20', '']})
+    assert columns['WhiteElo'].tolist() == [1500, -1, -1]
+    assert columns['Result'][:2].tolist() == [1.0, 0.5] and np.isnan(columns['Result'][2])
+    assert columns['BaseTime'].tolist() == [300, 600, -1] and columns['Increment'].tolist() == [2, 0, -1]
+    assert columns['ECO'].tolist() == ['B00', 'C20', '']
+
+
+def test_query(tmp_path):
+    games = list(file_parser(DATASET))
+    index = PgnIndex(DATASET)
+    query = "(WhiteElo >= 1550) & np.char.startswith(ECO, 'B') & (Plies > 60)"
+    ids = index.select(query)
+    expected = [i for i, g in enumerate(games) if int(g.headers['WhiteElo']) >= 1550 and g.headers['ECO'][0] == 'B'
+                and len(game_moves(g)) > 60]
+    assert ids.tolist() == expected and 0 < len(expected) < len(games)
+    assert index.select(lambda columns: columns['WhiteElo'] >= 1550).tolist() == \
+        [i for i, g in enumerate(games) if int(g.headers['WhiteElo']) >= 1550]
+    chained = [i for i, g in enumerate(games) if 3420 <= int(g.headers['WhiteElo']) + int(g.headers['BlackElo']) < 3460]
+    assert index.select("1710 <= (WhiteElo + BlackElo) / 2 < 1730").tolist() == chained and chained
+    # the query is parsed, anything but the columns, operators and allowed functions is rejected
+    for unsafe in ["WhiteElo.__class__", "np.load('games.npy')", "__import__('os')", "ECO[0] == 'B'", "Foo > 1",
+                   "WhiteElo >"]:
+        with pytest.raises(ValueError):
+            index.select(unsafe)
+
+    # underpromotions are stored as queen promotions
+    moves = [index_to_move(move_to_index(uci)) for i in expected for _, uci in game_states(games[i])]
+    n_last = len(game_moves(games[expected[-1]]))
+    dataset = MoveDataset(DATASET, max_games=expected[-1], cache_dir=str(tmp_path), query=query)
+    assert [dataset[i][1] for i in range(len(dataset))] == moves[:-n_last]
+    # only the selected games are built
+    assert len(np.load(os.path.join(dataset.dataset_dir, 'games.npy'))) == len(expected)
+    dataset = MoveDataset(DATASET, cache_dir=str(tmp_path), query=query, ingest_workers=2)
+    assert [dataset[i][1] for i in range(len(dataset))] == moves
+    dataset = MoveDataset(DATASET, board_transform=None, cache_dir=str(tmp_path), query=query, dedup=True)
+    samples = [(b1.fen(), m) for (b1, _), m in (dataset[i] for i in range(len(dataset)))]
+    assert sorted(samples) == sorted(set(samples)) and dataset.weights.sum() == len(moves)
+    dataset = MoveDataset(DATASET, board_transform=None, cache_dir=str(tmp_path), query=query, compact=True)
+    assert [dataset[i][1] for i in range(len(dataset))] == moves
+    streaming = StreamingMoveDataset(DATASET, board_transform=None, shuffle_buffer=0, query=query)
+    assert [m for _, m in streaming] == moves
+
+
+def test_move_dataset(tmp_path, monkeypatch):
+    # small shards, so that the samples are spread over several files
+    monkeypatch.setattr('games_from_dataset.SHARD_SAMPLES', 100)
+    states = list(itertools.chain.from_iterable(game_states(g) for g in itertools.islice(file_parser(DATASET), 5)))
+    for mode in ['array', 'matrix', 'tensor']:
+        dataset = MoveDataset(DATASET, max_games=5, board_transform=mode, cache_dir=str(tmp_path))
+        assert len(dataset) == len(states)
+        assert len(dataset.manifest['shards']) > 1
+        for i in [0, 1, 99, 100, len(states) - 1]:
+            (b1, b2), m = dataset[i]
+            (s1, s2), uci = states[i]
+            assert m == uci
+            assert b1.tolist() == np.array(BoardArray.to_low_level(s1, mode=mode)).reshape(b1.shape).tolist()
+            assert b2.tolist() == np.array(BoardArray.to_low_level(s2, mode=mode)).reshape(b2.shape).tolist()
+    dataset = MoveDataset(DATASET, max_games=5, board_transform=None, move_transform='index', cache_dir=str(tmp_path))
+    (b1, b2), m = dataset[len(states) - 1]
+    assert b2 == states[-1][0][1] and isinstance(m, int)
+
+
+def test_long_game_counters(tmp_path):
+    # the move counters of the 'array' mode do not saturate at the largest int8
+    fname = str(tmp_path / 'long.pgn')
+    with open(fname, 'w') as f:
+        f.write('[FEN "4k3/8/8/8/8/8/8/4K3 w - - 40 130"]\n[SetUp "1"]\n\n130. Kd2 Kd7 131. Ke3 *\n')
+    game = chess.pgn.read_game(open(fname))
+    board = game.board()
+    dataset = MoveDataset(fname, board_transform='array', cache_dir=str(tmp_path / 'cache'))
+    (b1, b2), _ = collate_batch(dataset.__getitems__(list(range(len(dataset)))))
+    for i, move in enumerate(game.mainline_moves()):
+        board.push(move)
+        expected = np.array(BoardArray.to_low_level(board, mode='array')).tolist()
+        assert board.fullmove_number > 127 and dataset[i][0][1].tolist() == b2[i].tolist() == expected
+
+
+def test_dataset_cache(tmp_path):
+    cache = DatasetCache(str(tmp_path / 'cache'), max_bytes=2 ** 30)
+
+    def build(params):
+        return lambda out_dir: build_dataset(DATASET, out_dir, params['max_games'])
+
+    paths = [cache.get(DATASET, {'max_games': n}, build({'max_games': n})) for n in [2, 3]]
+    # different build parameters coexist, the same ones are not built again
+    assert paths[0] != paths[1] and len(cache.entries()) == 2
+    assert cache.get(DATASET, {'max_games': 2}, None) == paths[0]
+    # a changed source gets a new key
+    source = tmp_path / 'games.pgn'
+    source.write_text(open(DATASET).read())
+    key = cache.key(str(source), {'max_games': 2})
+    assert key == os.path.basename(paths[0])
+    source.write_text(open(DATASET).read() + '\n')
+    assert cache.key(str(source), {'max_games': 2}) != key
+    # least recently used entries are evicted first
+    cache.max_bytes = 1
+    with cache.lock(paths[1]):
+        # a dataset in use is not removed
+        cache.evict(keep=paths[0])
+        assert sorted(cache.entries()) == sorted(paths)
+    cache.evict(keep=paths[0])
+    assert cache.entries() == [paths[0]]
+    # the directories of the crashed builds are removed once stale, the ones of the builds in progress are locked
+    builds = [tempfile.mkdtemp(prefix='.build-', dir=cache.cache_dir) for _ in range(3)]
+    with open(os.path.join(builds[2], '.lock'), 'a') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        for path in builds[1:]:
+            os.utime(path, (0, 0))
+        cache.evict(keep=paths[0])
+        assert [os.path.isdir(path) for path in builds] == [True, False, True]
+    cache.evict(keep=paths[0])
+    assert [os.path.isdir(path) for path in builds] == [True, False, False]
+    # a build that fails removes its directory
+
+    def fail(out_dir):
+        raise RuntimeError("build failed")
+
+    with pytest.raises(RuntimeError):
+        cache.get(DATASET, {'max_games': 4}, fail)
+    assert [name for name in os.listdir(cache.cache_dir) if name.startswith('.build-')] == \
+        [os.path.basename(builds[0])]
+
+
+def test_streaming_move_dataset():
+    # underpromotions are stored as queen promotions
+    states = [(tuple(s.fen() for s in pair), index_to_move(move_to_index(uci)))
+              for g in itertools.islice(file_parser(DATASET), 10) for pair, uci in game_states(g)]
+
+    def samples(dataset, **kwargs):
+        loader = data.DataLoader(dataset, batch_size=None, **kwargs)
+        return [(tuple(b.fen() for b in pair), uci) for pair, uci in loader]
+
+    dataset = StreamingMoveDataset(DATASET, max_games=10, board_transform=None, shuffle_buffer=0)
+    assert samples(dataset) == states
+    # games split among workers, shuffled in the buffer
+    dataset = StreamingMoveDataset(DATASET, max_games=10, board_transform=None, shuffle_buffer=50, seed=0)
+    shuffled = samples(dataset, num_workers=2)
+    assert shuffled != states and sorted(shuffled) == sorted(states)
+    # splits are disjoint and cover all the games
+    splits = [samples(StreamingMoveDataset(DATASET, max_games=10, board_transform=None, shuffle_buffer=0, split=s))
+              for s in [(0.0, 0.05), (0.05, 1.0)]]
+    assert len(splits[0]) > 0 and splits[0] + splits[1] == states
+    # smaller blocks for a smaller file, the splits that cannot have games are rejected
+    splits = [samples(StreamingMoveDataset(DATASET, max_games=10, board_transform=None, shuffle_buffer=0, split=s,
+                                           split_games=5)) for s in [(0.0, 0.6), (0.6, 1.0)]]
+    assert len(splits[1]) > 0 and sorted(splits[0] + splits[1]) == sorted(states)
+    with pytest.raises(ValueError):
+        StreamingMoveDataset(DATASET, max_games=10, split=(0.7, 0.8))
+    # the games are shared among the processes of a distributed job
+    replicas = [samples(StreamingMoveDataset(DATASET, max_games=10, board_transform=None, shuffle_buffer=0,
+                                             num_replicas=2, rank=rank), num_workers=2) for rank in range(2)]
+    assert all(replicas) and sorted(replicas[0] + replicas[1]) == sorted(states)
+    (b1, b2), m = next(iter(StreamingMoveDataset(DATASET, max_games=1, board_transform='matrix',
+                                                 move_transform='index', shuffle_buffer=0)))
+    assert b1.shape == (1, 8, 8) and m == move_to_index(chess.Move.from_uci(states[0][1]))
+
+
+def test_game_store(tmp_path):
+    games = list(itertools.islice(file_parser(DATASET), 10))
+    store = GameStore.from_records((encode_game_moves(g, keyframe_plies=5) for g in games), keyframe_plies=5)
+    store.save(str(tmp_path))
+    store = GameStore.load(str(tmp_path), keyframe_plies=5)
+    assert store.n_games == len(games) and len(store) == sum(len(game_moves(g)) for g in games)
+    for g, game in enumerate(games):
+        moves = list(game.mainline_moves())
+        assert store.game_moves(g) == moves
+        positions = encode_game(moves, mode='packed')
+        assert (store.positions(g, 0, len(moves) + 1) == positions).all()
+        assert (store.positions(g, 7, 9) == positions[7:9]).all()
+    # same samples as the dataset storing all the positions, underpromotions included
+    full = MoveDataset(DATASET, max_games=10, board_transform='tensor', cache_dir=str(tmp_path / 'cache'))
+    compact = MoveDataset(DATASET, max_games=10, board_transform='tensor', cache_dir=str(tmp_path / 'cache'),
+                          compact=True)
+    assert full.dataset_dir != compact.dataset_dir and len(full) == len(compact)
+    for i in range(len(full)):
+        (b1, b2), m = full[i]
+        (c1, c2), n = compact[i]
+        assert m == n and (b1 == c1).all() and (b2 == c2).all()
+
+
+def test_dedup_dataset(tmp_path, monkeypatch):
+    monkeypatch.setattr('games_from_dataset.SHARD_SAMPLES', 100)
+
+    def keys(dataset):
+        samples = (dataset[i] for i in range(len(dataset)))
+        return [(chess.polyglot.zobrist_hash(b1), m, b2.fen()) for (b1, b2), m in samples]
+
+    full = MoveDataset(DATASET, max_games=20, board_transform=None, cache_dir=str(tmp_path))
+    dedup = MoveDataset(DATASET, max_games=20, board_transform=None, cache_dir=str(tmp_path), dedup=True)
+    counts = collections.Counter(key[:2] for key in keys(full))
+    assert len(dedup) == len(counts) < len(full) and len(dedup.manifest['shards']) > 1
+    assert dict(zip((key[:2] for key in keys(dedup)), dedup.weights.tolist())) == counts
+    # each merged sample is its first occurrence
+    first = {}
+    for key in keys(full):
+        first.setdefault(key[:2], key)
+    assert keys(dedup) == list(first.values())
+    assert (full.weights == 1).all()
+
+
+def test_getitems(tmp_path, monkeypatch):
+    monkeypatch.setattr('games_from_dataset.SHARD_SAMPLES', 100)
+    for mode, move_transform, compact in [('matrix', 'index', False), ('tensor', 'one_hot', False),
+                                          ('array', None, False), ('tensor', 'index', True)]:
+        dataset = MoveDataset(DATASET, max_games=5, board_transform=mode, move_transform=move_transform,
+                              cache_dir=str(tmp_path), compact=compact)
+        indices = [len(dataset) - 1, 0, 150, 3, -2, 99, 100]
+        (b1, b2), m = collate_batch(dataset.__getitems__(indices))
+        (e1, e2), n = data.default_collate([dataset[i] for i in indices])
+        assert b1.is_contiguous() and b1.dtype == e1.dtype and b1.shape == e1.shape
+        assert (b1 == e1).all() and (b2 == e2).all()
+        assert m == n if move_transform is None else (m == n).all()
+    # through a DataLoader over a subset
+    loader = data.DataLoader(data.Subset(dataset, range(10, 50)), batch_size=16, collate_fn=collate_batch)
+    assert [len(m) for _, m in loader] == [16, 16, 8]
+    (b1, b2), m = collate_batch(dataset.__getitems__(list(range(10, 26))))
+    (e1, e2), n = next(iter(loader))
+    assert (b1 == e1).all() and (b2 == e2).all() and (m == n).all()
+    # the default collate of a plain DataLoader gives the same batches
+    (e1, e2), n = next(iter(data.DataLoader(data.Subset(dataset, range(10, 50)), batch_size=16)))
+    assert (b1 == e1).all() and (b2 == e2).all() and (m == n).all()
+    assert [len(m) for _, m in data.DataLoader(dataset, batch_size=2)][0] == 2
+
+
+PGN = """[Event "annotated"]
+[White "A"]
+[Black "B"]
+
+1. e4 {best by test} e5 (1... c5 2. Nf3 (2. c3) d6) 2. Nf3! $1 Nc6?! ; comment
+3. Bb5 a6 4. O-O 1-0
+
+[Event "from fen"]
+[FEN "4k3/P7/8/8/8/8/8/4K3 w - - 0 1"]
+[SetUp "1"]
+
+1. a8=N Kd7 *
+
+[Event "illegal"]
+
+1. e4 e5 2. Ke3 Nc6 *
+"""
+
+
+def test_read_mainlines():
+    expected = [game_moves(game) for game in file_parser(DATASET)]
+    assert [game_moves(game) for game in mainline_parser(DATASET)] == expected
+    games = list(read_mainlines(io.BytesIO(PGN.encode()), headers=('White',)))
+    f = io.StringIO(PGN)
+    parsed = [chess.pgn.read_game(f) for _ in range(3)]
+    assert [game_moves(game) for game in games] == [game_moves(game) for game in parsed]
+    assert games[0].headers == {'White': 'A'} and games[1].board() == parsed[1].board()
+    assert [len(game.errors) for game in games] == [0, 0, 1]
+
+
+def test_read_mainlines_index(tmp_path):
+    # the games (and their ids) are the same as the ones of the index, text before the first game is skipped
+    fname = str(tmp_path / 'games.pgn')
+    with open(fname, 'w') as f:
+        f.write('; exported by a tool\n1. d4 d5 *\n\n' + PGN)
+    index = PgnIndex(fname)
+    games = list(mainline_parser(fname))
+    assert len(games) == len(index) == 3
+    assert [game.headers.get('White', '') for game in games] == index.headers['White'].tolist()
+    assert [len(game.mainline_moves()) for game in games[:2]] == index.plies[:2].tolist()
+
+
+def test_mirror_dataset(tmp_path):
+    dataset = MoveDataset(DATASET, max_games=3, board_transform=None, cache_dir=str(tmp_path))
+    mirrored = MoveDataset(DATASET, max_games=3, board_transform=None, cache_dir=str(tmp_path), mirror=1.0)
+    for i in range(len(dataset)):
+        (b1, b2), m = dataset[i]
+        (c1, c2), n = mirrored[i]
+        assert c1.fen() == b1.mirror().fen() and c2.fen() == b2.mirror().fen()
+        move = chess.Move.from_uci(m)
+        assert n == chess.Move(chess.square_mirror(move.from_square), chess.square_mirror(move.to_square),
+                               move.promotion).uci()
+    train, val, _ = get_dataloader(DATASET, max_games=3, batch_size=8, num_workers=0, board_transform='tensor',
+                                   move_transform='index', cache_dir=str(tmp_path), mirror=1.0)
+    assert train.dataset.dataset.mirror == 1.0 and val.dataset.dataset.mirror == 0.0
+    # the streamed training samples are mirrored as well
+    streamed = StreamingMoveDataset(DATASET, max_games=3, board_transform=None, shuffle_buffer=0, mirror=1.0)
+    assert [((c1.fen(), c2.fen()), n) for (c1, c2), n in streamed] == \
+        [((c1.fen(), c2.fen()), n) for (c1, c2), n in (mirrored[i] for i in range(len(mirrored)))]
+    train, val, _ = get_dataloader(DATASET, batch_size=8, num_workers=0, streaming=True, mirror=1.0, split_games=20)
+    assert train.dataset.mirror == 1.0 and val.dataset.mirror == 0.0
+    for kwargs in [{'dedup': True}, {'compact': True}]:
+        with pytest.raises(ValueError):
+            get_dataloader(DATASET, max_games=3, streaming=True, **kwargs)
+
+
+def test_distributed_weighted_sampler():
+    weights = np.array([0.0, 1.0, 3.0, 0.0, 4.0])
+    samplers = [DistributedWeightedSampler(weights, num_replicas=2, rank=rank) for rank in range(2)]
+    drawn = [list(sampler) for sampler in samplers]
+    assert [len(sampler) for sampler in samplers] == [3, 3] and all(len(d) == 3 for d in drawn)
+    assert set(drawn[0] + drawn[1]) <= {1, 2, 4}
+    # reproducible, reshuffled at each epoch
+    assert list(samplers[0]) == drawn[0]
+    counts = collections.Counter()
+    for epoch in range(200):
+        samplers[1].set_epoch(epoch)
+        counts.update(samplers[1])
+    assert counts[4] > counts[2] > counts[1] > 0
@@ -0,0 +1,54 @@
+import os
+
+import torch
+
+from utils.utils_checkpoint import CheckpointManager, BEST_NAME, new_run_directory
+
+
+def test_checkpoint_manager(tmp_path):
+    directory = str(tmp_path / 'run')
+    manager = CheckpointManager(directory, keep_last=2)
+    weights = torch.zeros(3)
+    for epoch, loss in enumerate([3.0, 1.0, 2.0, 4.0]):
+        weights += 1
+        manager.save({'weights': weights, 'loader_state': {'epoch': epoch + 1}}, epoch, metric=loss)
+    manager.wait()
+    # snapshots of the state when it was saved, not of the tensors trained afterwards
+    assert [os.path.basename(path) for path in manager.checkpoints()] == ['epoch_0002.pt', 'epoch_0003.pt']
+    latest = torch.load(manager.latest())
+    assert latest['epoch'] == 3 and latest['weights'].tolist() == [4.0] * 3 and latest['loader_state'] == {'epoch': 4}
+    best = torch.load(os.path.join(directory, BEST_NAME))
+    assert best['epoch'] == 1 and best['weights'].tolist() == [2.0] * 3 and best['best_metric'] == 1.0
+    # no temporary files are left
+    assert sorted(os.listdir(directory)) == [BEST_NAME, 'epoch_0002.pt', 'epoch_0003.pt']
+    manager.close()
+    # a resumed run keeps the best checkpoint unless it is improved
+    manager = CheckpointManager(directory, keep_last=2, best=best['best_metric'])
+    manager.save({'weights': weights}, 4, metric=1.5)
+    manager.close()
+    assert torch.load(os.path.join(directory, BEST_NAME))['epoch'] == 1
+    # also when the best metric is not given, it is the one of best.pt
+    manager = CheckpointManager(directory, keep_last=2)
+    assert manager.best == 1.0
+    manager.close()
+
+
+def test_new_run_directory(tmp_path):
+    # runs started at the same time get their own directory
+    paths = [new_run_directory(str(tmp_path), 'run') for _ in range(3)]
+    assert [os.path.basename(path) for path in paths] == ['run', 'run-1', 'run-2']
+    assert all(os.path.isdir(path) for path in paths)
+
+
+def test_checkpoint_permissions(tmp_path):
+    # the checkpoints get the permissions of the umask at the time they are written, as any file created by open
+    for umask, mode in [(0o022, 0o644), (0o077, 0o600)]:
+        previous = os.umask(umask)
+        try:
+            manager = CheckpointManager(str(tmp_path / oct(umask)))
+            path = manager.save({'weights': torch.zeros(3)}, 0, metric=1.0)
+            manager.close()
+        finally:
+            os.umask(previous)
+        assert os.stat(path).st_mode & 0o777 == mode
+        assert os.stat(os.path.join(manager.directory, BEST_NAME)).st_mode & 0o777 == mode
@@ -1,2 +1,3 @@
-from .utils import set_random_seed
-from .utils_model import *
\ No newline at end of file
+from .utils import set_random_seed, init_distributed, is_main_process, cleanup_distributed
+from .utils_model import *
+from .utils_checkpoint import CheckpointManager, new_run_directory
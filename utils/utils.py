@@ -1,4 +1,7 @@
+import os
+
 import torch
+import torch.distributed as dist
 import random
 import numpy as np
 
@@ -9,3 +12,34 @@ def set_random_seed(seed):
     torch.manual_seed(seed)
     torch.cuda.manual_seed(seed)
     torch.cuda.manual_seed_all(seed)
+
+
+def init_distributed(backend: str = 'gloo', threads: int = None) -> tuple[int, int, int]:
+    """
+    Join the process group of a job launched by torchrun, which sets RANK, LOCAL_RANK, WORLD_SIZE,
+    LOCAL_WORLD_SIZE and the address of the rendezvous in the environment.
+    :param backend: backend of the process group, gloo runs on the cpu of any number of nodes
+    :param threads: intra-op threads of this process. If None, the cores of the node are shared among its processes
+    (torchrun sets OMP_NUM_THREADS to 1, which would leave most of them idle)
+    :return: rank, local rank and world size
+    """
+    if 'RANK' not in os.environ:
+        raise RuntimeError("Error: the distributed mode requires to be launched with torchrun")
+    dist.init_process_group(backend=backend)
+    local_rank = int(os.environ['LOCAL_RANK'])
+    if threads is None:
+        threads = max(1, (os.cpu_count() or 1) // int(os.environ.get('LOCAL_WORLD_SIZE', 1)))
+    torch.set_num_threads(threads)
+    return dist.get_rank(), local_rank, dist.get_world_size()
+
+
+def is_main_process() -> bool:
+    """
+    True if this process logs and saves the checkpoints: the one of rank 0, or the only one if not distributed.
+    """
+    return not (dist.is_available() and dist.is_initialized()) or dist.get_rank() == 0
+
+
+def cleanup_distributed():
+    if dist.is_available() and dist.is_initialized():
+        dist.destroy_process_group()
@@ -0,0 +1,155 @@
+import concurrent.futures
+import itertools
+import os
+import re
+import shutil
+import uuid
+
+import torch
+
+CHECKPOINT_NAME = "epoch_{:04d}.pt"
+CHECKPOINT_PATTERN = re.compile(r"epoch_\d+\.pt")
+BEST_NAME = "best.pt"
+
+
+def _to_cpu(state):
+    # copy of the tensors of a (nested) state dict in cpu memory, detached from the ones still being trained
+    if isinstance(state, torch.Tensor):
+        return state.detach().to('cpu', copy=True)
+    if isinstance(state, dict):
+        return {key: _to_cpu(value) for key, value in state.items()}
+    if isinstance(state, (list, tuple)):
+        return type(state)(_to_cpu(value) for value in state)
+    return state
+
+
+def _replace(write: callable, path: str):
+    # call write(tmp) on a temporary file of the directory of path and rename it to path, so that path is always
+    # either the previous file or the complete new one
+    directory, name = os.path.split(path)
+    tmp = os.path.join(directory, f'.{name}.{uuid.uuid4().hex}')
+    # created as open does, with the permissions of the umask (mkstemp creates files readable only by the owner)
+    os.close(os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o666))
+    try:
+        write(tmp)
+        os.replace(tmp, path)
+    except BaseException:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+
+
+def _save(state: dict, path: str):
+    with open(path, 'wb') as f:
+        torch.save(state, f)
+        f.flush()
+        os.fsync(f.fileno())
+
+
+def _link(src: str, path: str):
+    # replace the (empty) file path with the content of src
+    os.remove(path)
+    try:
+        # the best checkpoint shares the file of its epoch, which can then be removed by the retention
+        os.link(src, path)
+    except OSError:
+        shutil.copyfile(src, path)
+
+
+def new_run_directory(root: str, name: str) -> str:
+    """
+    Create the directory of a new run in @root, named @name, or @name-<n> if another run already has that name.
+    """
+    os.makedirs(root, exist_ok=True)
+    for n in itertools.count():
+        directory = os.path.join(root, name if n == 0 else f"{name}-{n}")
+        try:
+            os.mkdir(directory)
+            return directory
+        except FileExistsError:
+            continue
+
+
+class CheckpointManager:
+
+    def __init__(self, directory: str, keep_last: int = 3, minimize: bool = True, best: float = None):
+        """
+        Checkpoints of a training run in @directory: `save` copies the state to cpu memory and returns, the file is
+        written by a background thread to a temporary file renamed to epoch_<epoch>.pt, so that a crash never leaves a
+        truncated checkpoint. Only the last @keep_last epochs are kept, along with best.pt, the checkpoint with the best
+        validation metric.
+        :param directory: directory of the checkpoints, created if it does not exist
+        :param keep_last: number of epoch checkpoints kept
+        :param minimize: the best metric is the lowest one (e.g. a loss) if True, the highest one otherwise
+        :param best: best metric of the run, e.g. the 'best_metric' of the checkpoint being resumed. If None, the one
+        of best.pt if @directory has it
+        """
+        if keep_last < 1:
+            raise ValueError("Error: argument keep_last must be at least 1")
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.keep_last = keep_last
+        self.minimize = minimize
+        best_path = os.path.join(directory, BEST_NAME)
+        if best is None and os.path.isfile(best_path):
+            best = torch.load(best_path, map_location='cpu').get('best_metric')
+        self.best = best
+        # a single thread, so that the checkpoints are written (and pruned) in order
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix='checkpoint')
+        self.pending = []
+
+    def is_better(self, metric: float) -> bool:
+        return self.best is None or (metric < self.best if self.minimize else metric > self.best)
+
+    def save(self, state: dict, epoch: int, metric: float = None) -> str:
+        """
+        Snapshot @state and schedule its writing as the checkpoint of @epoch, which is also the best one if @metric
+        improves the best metric. The file is complete when `wait` returns.
+        :param state: the checkpoint, e.g. a dict of state dicts
+        :param epoch: epoch of the checkpoint
+        :param metric: validation metric of the checkpoint, None if it was not evaluated
+        :return: path of the checkpoint
+        """
+        # errors of the previous writes are raised here, instead of being lost
+        self._collect(block=False)
+        is_best = metric is not None and self.is_better(metric)
+        if is_best:
+            self.best = metric
+        state = _to_cpu({**state, 'epoch': epoch, 'metric': metric, 'best_metric': self.best})
+        path = os.path.join(self.directory, CHECKPOINT_NAME.format(epoch))
+        self.pending.append(self.executor.submit(self._write, state, path, is_best))
+        return path
+
+    def _write(self, state: dict, path: str, is_best: bool):
+        _replace(lambda tmp: _save(state, tmp), path)
+        if is_best:
+            _replace(lambda tmp: _link(path, tmp), os.path.join(self.directory, BEST_NAME))
+        for old in self.checkpoints()[:-self.keep_last]:
+            os.remove(old)
+
+    def _collect(self, block: bool):
+        done = [future for future in self.pending if block or future.done()]
+        self.pending = [future for future in self.pending if future not in done]
+        for future in done:
+            future.result()
+
+    def checkpoints(self) -> list[str]:
+        """
+        Paths of the epoch checkpoints written so far, from the oldest one.
+        """
+        return sorted(os.path.join(self.directory, name) for name in os.listdir(self.directory)
+                      if CHECKPOINT_PATTERN.fullmatch(name))
+
+    def latest(self) -> str | None:
+        checkpoints = self.checkpoints()
+        return checkpoints[-1] if checkpoints else None
+
+    def wait(self):
+        """
+        Wait for the scheduled checkpoints to be written.
+        """
+        self._collect(block=True)
+
+    def close(self):
+        self.wait()
+        self.executor.shutdown()
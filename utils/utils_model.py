@@ -35,3 +35,28 @@ def get_loss_func(type: str):
     else:
         raise NotImplementedError(f'{type} loss function not implemented yet')
     return loss_func
+
+
+def get_precision(type: str):
+    # compute dtype of the autocast regions, None to run in fp32
+    if type == 'fp32':
+        dtype = None
+    elif type == 'bf16':
+        dtype = torch.bfloat16
+    elif type == 'fp16':
+        dtype = torch.float16
+    else:
+        raise NotImplementedError(f'{type} precision not implemented yet')
+    return dtype
+
+
+def prepare_model(model: nn.Module, device, compile: bool = False, channels_last: bool = False) -> nn.Module:
+    """
+    Move @model to @device, in channels last memory format if requested, and compile it if requested.
+    The compiled module shares the parameters of @model, whose state dict is the one to be saved.
+    """
+    if hasattr(model, '_orig_mod'):
+        # already compiled
+        return model
+    model = model.to(device, memory_format=torch.channels_last) if channels_last else model.to(device)
+    return torch.compile(model) if compile else model